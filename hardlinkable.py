@@ -36,10 +36,13 @@
 
 
 import copy as _copy
+import binascii as _binascii
+import errno as _errno
 import filecmp as _filecmp
 import logging as _logging
 import os as _os
 import re as _re
+import signal as _signal
 import stat as _stat
 import sys as _sys
 import time as _time
@@ -51,7 +54,7 @@ from optparse import TitledHelpFormatter as _TitledHelpFormatter
 from optparse import Values as _Values
 
 try:
-    from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+    from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
     NamePair = Tuple[str, str]
     InoSet = Set[int]
 except ImportError:
@@ -88,12 +91,189 @@ except NameError:
     # Import of Set messes with mypy in --py2 mode
     from sets import Set as set  # type: ignore
 
+# os.scandir() provides directory entry types (and stat data) without an
+# extra stat call per entry.  Available since Python 3.5
+try:
+    _scandir = _os.scandir  # type: ignore
+except AttributeError:
+    _scandir = None
+
+# Thread pools are used for the optional concurrent directory walking and
+# file matching
+try:
+    from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+except ImportError:
+    _ThreadPoolExecutor = None  # type: ignore
+
+# Process pools compute content digests on multiple cores (--hash-workers).
+# Available since Python 3.2
+try:
+    from concurrent.futures import ProcessPoolExecutor as _ProcessPoolExecutor
+    from concurrent.futures import wait as _wait_futures
+    from concurrent.futures import FIRST_COMPLETED as _FIRST_COMPLETED
+except ImportError:
+    _ProcessPoolExecutor = None  # type: ignore
+
+# The open file limit bounds the pool of open files.  Unix only
+try:
+    import resource as _resource
+except ImportError:
+    _resource = None  # type: ignore
+
+# Locks allow the digest cache to be shared by concurrent matching threads
+try:
+    import threading as _threading
+except ImportError:
+    import dummy_threading as _threading  # type: ignore
+
+# Strong hashes allow matching whole file contents by digest, rather than by
+# pairwise comparisons.  Available since Python 2.5 (blake2b since 3.6)
+try:
+    import hashlib as _hashlib
+    _HASH_ALGORITHMS = [name for name in ('blake2b', 'sha256', 'sha1')
+                        if hasattr(_hashlib, name)]
+except ImportError:
+    _hashlib = None  # type: ignore
+    _HASH_ALGORITHMS = []
+
+# Ordered dicts provide the least recently used ordering of the comparison
+# cache.  Available since Python 2.7
+try:
+    from collections import OrderedDict as _OrderedDict
+except ImportError:
+    _OrderedDict = None  # type: ignore
+
+# SQLite stores the optional persistent digest cache.  Available since Python
+# 2.5
+try:
+    import sqlite3 as _sqlite3
+except ImportError:
+    _sqlite3 = None  # type: ignore
+
+# Positional reads sample file regions without seeking.  Available since
+# Python 3.3
+try:
+    _pread = _os.pread  # type: ignore
+except AttributeError:
+    def _pread(fd, n, offset):
+        # type: (int, int, int) -> bytes
+        _os.lseek(fd, offset, _os.SEEK_SET)
+        return _os.read(fd, n)
+
+# Seeking to data and holes allows skipping the holes of sparse files.
+# Available since Python 3.3 (on supporting platforms)
+_SEEK_DATA = getattr(_os, 'SEEK_DATA', None)
+_SEEK_HOLE = getattr(_os, 'SEEK_HOLE', None)
+
+# Reading without access time updates or page cache pollution (--gentle-io).
+# Available since Python 3.3 (on supporting platforms)
+_O_NOATIME = getattr(_os, 'O_NOATIME', 0)
+_posix_fadvise = getattr(_os, 'posix_fadvise', None)
+
+# The FIEMAP ioctl finds the physical location of file data (--ordered-reads).
+# Linux only; elsewhere files are ordered by inode number.
+try:
+    import fcntl as _fcntl
+    import struct as _struct
+except ImportError:
+    _fcntl = None  # type: ignore
+if not _sys.platform.startswith('linux'):
+    _fcntl = None  # type: ignore
+_FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_FORMAT = '=QQIIII'
+_FIEMAP_EXTENT_SIZE = 56
+
 # Python 3 moved intern() to sys module
 try:
     _intern = intern  # type: ignore
 except NameError:
     _intern = _sys.intern  # type: ignore
 
+# Default size of the blocks read when comparing or hashing file contents
+DEFAULT_READ_BLOCK = "128k"
+
+# Default maximum number of cached file comparison results
+DEFAULT_COMPARISON_CACHE_SIZE = 65536
+
+# Default maximum total size of the cached file head blocks
+DEFAULT_BLOCK_CACHE_SIZE = "128m"
+
+# Small files (--small-file-size) up to this size are keyed by their content,
+# larger ones by a strong digest of it (which is no smaller than this)
+DEFAULT_SMALL_FILE_INLINE = "64"
+
+# Digest cache writes are batched into transactions of this many rows, and
+# entries unused for this many seconds are removed.  A cache locked by
+# another process is waited on for this many seconds.
+_DIGEST_CACHE_BATCH = 1000
+_DIGEST_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+_DIGEST_CACHE_TIMEOUT = 5.0
+
+# Digests stored in file xattrs (--digest-xattrs) use this prefix, followed by
+# the digest stage name
+_DIGEST_XATTR_PREFIX = "user.hardlinkable."
+
+# The xattr fingerprint of files whose xattrs can't be read, and the bucket
+# key stand-in for the fingerprint of an inode whose xattrs haven't been read
+_UNREADABLE_XATTRS = "unreadable"
+_UNKEYED_XATTRS = "unkeyed"
+
+# Lockstep comparisons read from no more than this many files at once
+_LOCKSTEP_MAX_FILES = 64
+
+# The pool of open files holds at most this many files, and no more than half
+# of the open file limit (less what the lockstep comparisons may use)
+_FILE_POOL_MAX = 4096
+
+# Each task of the hashing processes (--hash-workers) digests this many files,
+# with at most this many tasks in flight per process
+_HASH_TASK_FILES = 16
+_HASH_TASKS_PER_WORKER = 2
+
+# Content digest stages, each only computed for files whose previous stage
+# digests were equal: the first 8K, the last 8K, 8K regions sampled from
+# between them (for large files), and the full content (--hash)
+_DIGEST_HEAD = 'head'
+_DIGEST_TAIL = 'tail'
+_DIGEST_SAMPLE = 'sample'
+_DIGEST_FULL = 'full'
+_DIGEST_STAGES = (_DIGEST_HEAD, _DIGEST_TAIL, _DIGEST_SAMPLE, _DIGEST_FULL)
+
+# Bucket search strategies chosen by the match planner (--match-planner):
+# pairwise comparisons, comparisons of all candidates at once (N-way), head
+# digests only, all the digest stages, and full content digests (--hash)
+_STRATEGY_LINEAR = 'linear'
+_STRATEGY_NWAY = 'nway'
+_STRATEGY_HEAD = 'head'
+_STRATEGY_STAGED = 'staged'
+_STRATEGY_FULL = 'full'
+_STRATEGIES = (_STRATEGY_LINEAR, _STRATEGY_NWAY, _STRATEGY_HEAD,
+               _STRATEGY_STAGED, _STRATEGY_FULL)
+
+# The match planner's assumed read throughput (bytes per second), file open
+# latency (seconds), in-memory comparison rate (bytes per second), and
+# fraction of candidates surviving a digest stage, until measured.  Each
+# measurement has this weight in the moving averages, and throughput is only
+# measured from searches that read at least this many bytes.
+_PLANNER_READ_RATE = 100 * 1024 * 1024
+_PLANNER_OPEN_TIME = 0.0001
+_PLANNER_COMPARE_RATE = 1024 * 1024 * 1024
+_PLANNER_SURVIVAL = 0.5
+_PLANNER_WEIGHT = 0.1
+_PLANNER_MIN_BYTES = 64 * 1024
+
+# Default minimum file size for the sampled digest, which reads one region per
+# _SAMPLE_SPACING bytes of file, up to _SAMPLE_MAX_REGIONS regions
+DEFAULT_SAMPLE_THRESH = "1m"
+_SAMPLE_SPACING = 16 * 1024 * 1024
+_SAMPLE_MAX_REGIONS = 64
+
+# The os.stat_result fields that are not part of its sequence
+_STAT_ATTRIBUTE_FIELDS = ('st_atime', 'st_mtime', 'st_ctime',
+                          'st_atime_ns', 'st_mtime_ns', 'st_ctime_ns',
+                          'st_blksize', 'st_blocks', 'st_rdev',
+                          'st_flags', 'st_gen', 'st_birthtime')
+
 __all__ = ["Hardlinkable", "FileInfo", "LinkingStats", "get_default_parser_options"]
 
 # global declarations
@@ -159,6 +339,51 @@ by hard linking identical files.  It can also perform the linking."""
                           help="Output results as JSON",
                           action="store_true", default=False,)
 
+    # Allow concurrent directory walking if thread pools are available
+    if _ThreadPoolExecutor is not None:
+        parser.add_option("--walk-threads", dest="walk_threads", metavar="N",
+                          help="Number of threads used to walk directories (default: %default)",
+                          action="store", type="int", default=1,)
+        parser.add_option("--match-threads", dest="match_threads", metavar="N",
+                          help="Number of threads used to match files (default: %default)",
+                          action="store", type="int", default=1,)
+
+    # Allow digests computed by multiple processes if process pools are available
+    if _ProcessPoolExecutor is not None:
+        parser.add_option("--hash-workers", dest="hash_workers", metavar="N",
+                          help="Number of processes used to compute digests (default: %default)",
+                          action="store", type="int", default=1,)
+
+    parser.add_option("--read-block", dest="read_block", metavar="SZ",
+                      help="Block size for reading file contents (default: %default)",
+                      default=DEFAULT_READ_BLOCK,)
+
+    # Allow a persistent digest cache if sqlite3 module is present
+    if _sqlite3 is not None:
+        parser.add_option("--digest-cache", dest="digest_cache", metavar="PATH",
+                          help="Store and reuse file content digests in PATH",
+                          action="store", default=None,)
+
+    # Allow digests stored in xattrs if xattr module is present
+    if xattr is not None:
+        parser.add_option("--digest-xattrs", dest="digest_xattrs",
+                          help="Store and reuse file content digests in xattrs",
+                          action="store_true", default=False,)
+
+    # Allow page cache and atime neutral reads if posix_fadvise is available
+    if _posix_fadvise is not None:
+        parser.add_option("--gentle-io", dest="gentle_io",
+                          help="Avoid file atime updates and page cache eviction",
+                          action="store_true", default=False,)
+
+    parser.add_option("--ordered-reads", dest="ordered_reads",
+                      help="Read files in on-disk order (for spinning disks)",
+                      action="store_true", default=False,)
+
+    parser.add_option("--small-file-size", dest="small_file_size", metavar="SZ",
+                      help="Key files up to SZ by their content (default: %default)",
+                      default="0",)
+
     # Do not print non-error output (overrides verbose)
     parser.add_option("--quiet", dest="quiet",
                       help=_SUPPRESS_HELP,
@@ -174,6 +399,48 @@ by hard linking identical files.  It can also perform the linking."""
                       help=_SUPPRESS_HELP,
                       action="store", default=DEFAULT_LINEAR_SEARCH_THRESH,)
 
+    # hidden comparison cache size option, bounds the cached comparison results
+    parser.add_option("--comparison-cache-size", dest="comparison_cache_size",
+                      help=_SUPPRESS_HELP,
+                      action="store", type="int",
+                      default=DEFAULT_COMPARISON_CACHE_SIZE,)
+
+    # hidden block cache size option, bounds the memory of cached head blocks
+    parser.add_option("--block-cache-size", dest="block_cache_size",
+                      help=_SUPPRESS_HELP,
+                      action="store", default=DEFAULT_BLOCK_CACHE_SIZE,)
+
+    # hidden match planner option, chooses the strategy of each bucket search
+    # from a cost model (rather than by linear-search-thresh)
+    parser.add_option("--match-planner", dest="match_planner",
+                      help=_SUPPRESS_HELP,
+                      action="store_true", default=False,)
+
+    # hidden candidate order option, chooses the policy for ordering the
+    # candidates of a bucket search (likeliest matches first)
+    parser.add_option("--candidate-order", dest="candidate_order",
+                      help=_SUPPRESS_HELP,
+                      action="store", type="choice",
+                      choices=sorted(_CANDIDATE_ORDERS), default="likely",)
+
+    # hidden file pool size option, bounds the files kept open for reuse
+    # (sized against the open file limit by default)
+    parser.add_option("--file-pool-size", dest="file_pool_size",
+                      help=_SUPPRESS_HELP,
+                      action="store", type="int", default=None,)
+
+    # hidden small file inline size option, bounds the memory of the content
+    # keys of small files
+    parser.add_option("--small-file-inline", dest="small_file_inline",
+                      help=_SUPPRESS_HELP,
+                      action="store", default=DEFAULT_SMALL_FILE_INLINE,)
+
+    # hidden sampled digest threshold option, the minimum file size for
+    # digesting regions between the head and tail
+    parser.add_option("--sample-thresh", dest="sample_thresh",
+                      help=_SUPPRESS_HELP,
+                      action="store", default=DEFAULT_SAMPLE_THRESH,)
+
     group = _OptionGroup(parser, title="File Matching", description="""\
 File content must always match exactly to be linkable.  Use --content-only with
 caution, as it can lead to surprising results, including files becoming owned
@@ -210,6 +477,16 @@ by another user.
                      help="Only file contents have to match",
                      action="store_true", default=False,)
 
+    if _HASH_ALGORITHMS:
+        group.add_option("--hash", dest="hash_algorithm", metavar="ALG",
+                         help=("Match contents by full file digest (%s)" %
+                               "|".join(_HASH_ALGORITHMS)),
+                         action="store", type="choice",
+                         choices=_HASH_ALGORITHMS, default=None,)
+        group.add_option("--verify", dest="verify_hash",
+                         help="Compare contents of --hash matched files",
+                         action="store_true", default=False,)
+
     group = _OptionGroup(parser,
                          title="Name Matching (may specify multiple times)",)
     parser.add_option_group(group)
@@ -262,6 +539,25 @@ def _options_validation(parser, options):
             options.max_file_size = _humanized_number_to_bytes(options.max_file_size)  # type: ignore
         except ValueError:
             parser.error("option -S: invalid integer value: '%s'" % options.max_file_size)
+    try:
+        options.read_block = _humanized_number_to_bytes(options.read_block)  # type: ignore
+    except ValueError:
+        parser.error("option --read-block: invalid integer value: '%s'" % options.read_block)
+    try:
+        options.block_cache_size = _humanized_number_to_bytes(options.block_cache_size)  # type: ignore
+    except ValueError:
+        parser.error("option --block-cache-size: invalid integer value: '%s'" %
+                     options.block_cache_size)
+    try:
+        options.small_file_size = _humanized_number_to_bytes(options.small_file_size)  # type: ignore
+    except ValueError:
+        parser.error("option --small-file-size: invalid integer value: '%s'" %
+                     options.small_file_size)
+    try:
+        options.small_file_inline = _humanized_number_to_bytes(options.small_file_inline)  # type: ignore
+    except ValueError:
+        parser.error("option --small-file-inline: invalid integer value: '%s'" %
+                     options.small_file_inline)
     # Check validity of min/max size options
     if options.min_file_size < 0:
         parser.error("--min_size cannot be negative")
@@ -269,6 +565,8 @@ def _options_validation(parser, options):
         parser.error("--max_size cannot be negative")
     if options.max_file_size is not None and options.max_file_size < options.min_file_size:
         parser.error("--max_size cannot be smaller than --min_size")
+    if options.read_block < 1:
+        parser.error("--read-block must be at least 1")
 
     # If linking is enabled, output a message early to indicate what is
     # happening in case the program is set to zero verbosity and is taking a
@@ -293,6 +591,42 @@ def _options_validation(parser, options):
             else:
                 parser.error(err_str % options.linear_search_thresh)
 
+    # Verify that sample_thresh is a non-negative size, or "none"
+    if options.sample_thresh is not None:
+        err_str = ("Invalid value '%s' for sample-thresh. "
+                   "Should be a non-negative size")
+        try:
+            n = _humanized_number_to_bytes(options.sample_thresh)
+            if n < 0:
+                parser.error(err_str % options.sample_thresh)
+            options.sample_thresh = n  # type: ignore
+        except ValueError:
+            if options.sample_thresh.lower() == "none":
+                options.sample_thresh = None  # type: ignore
+            else:
+                parser.error(err_str % options.sample_thresh)
+
+    if options.comparison_cache_size < 0:
+        parser.error("--comparison-cache-size cannot be negative")
+    if options.block_cache_size < 0:
+        parser.error("--block-cache-size cannot be negative")
+    if options.small_file_size < 0:
+        parser.error("--small-file-size cannot be negative")
+    if options.file_pool_size is not None and options.file_pool_size < 0:
+        parser.error("--file-pool-size cannot be negative")
+    if options.small_file_inline < 0:
+        parser.error("--small-file-inline cannot be negative")
+
+    if _ThreadPoolExecutor is not None and options.walk_threads < 1:
+        parser.error("--walk-threads must be at least 1")
+    if _ThreadPoolExecutor is not None and options.match_threads < 1:
+        parser.error("--match-threads must be at least 1")
+    if _ProcessPoolExecutor is not None and options.hash_workers < 1:
+        parser.error("--hash-workers must be at least 1")
+
+    if _HASH_ALGORITHMS and options.verify_hash and options.hash_algorithm is None:
+        parser.error("--verify requires the --hash option")
+
     # Setup/reconcile output options (debugging is not overridden)
     if options.quiet:
         # Based on verbosity, enable extra stats storage when quiet option is
@@ -323,6 +657,15 @@ class Hardlinkable(object):
         self.stats = LinkingStats(options)
         self.progress = _Progress(options, self.stats)
         self._fsdevs = {}  # type: Dict[int, _FSDev]
+        self._comparison_cache = _ComparisonCache(options.comparison_cache_size)
+        self._block_cache = _BlockCache(options.block_cache_size)
+        self._file_pool = _FilePool(self._file_pool_size(), self._gentle_io())
+        self._candidate_order = _CANDIDATE_ORDERS[options.candidate_order]()
+        self._planner = _MatchPlanner(options.read_block)
+        # Content bytes read and files opened, for measuring planned searches
+        self._num_bytes_read = 0
+        self._num_opens = 0
+        self._digest_cache = None  # type: Optional[_DigestCache]
 
     def linkables(self, directories):
         # type: (List) -> Iterable[NamePair]
@@ -396,10 +739,35 @@ class Hardlinkable(object):
         """Yield FileInfo for all non-excluded/matched files"""
         options = self.options
 
+        # (The threads list directories with scandir, else os.walk() is used)
+        walk_threads = 0
+        if _ThreadPoolExecutor is not None and _scandir is not None:
+            walk_threads = options.walk_threads
+        if walk_threads > 1:
+            walker = _ThreadedDirWalker(options, walk_threads)
+            walk_dir_entries = walker.walk
+        else:
+            walker = None
+            walk_dir_entries = lambda top_dir: _walk_dir_entries(top_dir, options)
+
+        try:
+            for fileinfo in self._walked_fileinfo(directories, walk_dir_entries):
+                yield fileinfo
+        finally:
+            if walker is not None:
+                walker.close()
+
+    def _walked_fileinfo(self, directories, walk_dir_entries):
+        # type: (List, Callable) -> Iterable[FileInfo]
+        """Yield FileInfo for all non-excluded/matched files, from the given
+        directory walking function"""
+        options = self.options
+
         # Now go through all the directories that have been added.
         for top_dir in directories:
-            # Use topdown=True for directory search pruning. followlinks is False
-            for dirpath, dirs, filenames in _os.walk(top_dir, topdown=True):
+            # Topdown walk allows directory search pruning. Symlinks to
+            # directories are not followed.
+            for dirpath, dirs, scanned_entries in walk_dir_entries(top_dir):
                 assert dirpath
 
                 # If excludes match any of the subdirs (or the current dir), skip
@@ -414,25 +782,28 @@ class Hardlinkable(object):
 
                 self.stats.found_directory()
 
+                # Extract the normalized path directory name once per
+                # directory, and try to save space on redundant dirname
+                # storage by interning
+                dirname = _intern(_normalized_dirname(dirpath))
+                path_prefix = _pathname_prefix(dirname)
+
                 # Loop through all the files in the directory
-                for filename in filenames:
+                for entry_type, filename, value in scanned_entries:
                     assert filename
-                    pathname = _os.path.normpath(_os.path.join(dirpath, filename))
-                    if _found_excluded_regex(filename, options.excludes):
+                    pathname = path_prefix + filename
+                    if entry_type == _ENTRY_EXCLUDED:
                         self.stats.excluded_file(pathname)
                         continue
-                    if not _found_matched_filename_regex(filename, options.matches):
+                    if entry_type == _ENTRY_NOT_MATCHED:
                         self.stats.included_file(pathname)
                         continue
-
-                    try:
-                        statinfo = _os.lstat(pathname)
-                    except OSError:
-                        error = _sys.exc_info()[1]
-                        _logging.warning("Unable to get stat info for: %s\n%s" % (pathname, error))
+                    if entry_type == _ENTRY_STAT_FAILED:
+                        _logging.warning("Unable to get stat info for: %s\n%s" % (pathname, value))
                         continue
 
-                    # Is it a regular file?
+                    assert entry_type == _ENTRY_STAT
+                    statinfo = value
                     assert not _stat.S_ISDIR(statinfo.st_mode)
                     if not _stat.S_ISREG(statinfo.st_mode):
                         continue
@@ -458,12 +829,6 @@ class Hardlinkable(object):
                     # Bump statistics count of regular files found.
                     self.stats.found_regular_file(pathname)
 
-                    # Extract the normalized path directory name
-                    dirname = _os.path.dirname(pathname)
-
-                    # Try to save space on redundant dirname and filename
-                    # storage by interning
-                    dirname = _intern(dirname)
                     filename = _intern(filename)
                     yield FileInfo(dirname, filename, statinfo)
 
@@ -471,11 +836,28 @@ class Hardlinkable(object):
         # type: (List) -> Iterable[Tuple[FileInfo, FileInfo]]
         """Perform the walk, collect and sort linking data, and yield linkable
         fileinfo pairs."""
-        for fileinfo in self.matched_fileinfo(directories):
-            self.progress.show_dirs_files_found()
-            self._find_identical_files(fileinfo)
+        self._open_digest_cache()
+        try:
+            if self.options.ordered_reads:
+                fileinfos = self._ordered_fileinfo(directories)  # type: Iterable[FileInfo]
+            elif self._hash_workers() > 1:
+                fileinfos = self._hashed_fileinfo(directories)
+            else:
+                fileinfos = self._found_fileinfo(directories)
+            match_threads = self._match_threads()
+            if match_threads > 1:
+                self._match_concurrently(list(fileinfos), match_threads)
+            else:
+                for fileinfo in fileinfos:
+                    self._find_identical_files(fileinfo)
+        finally:
+            self._close_digest_cache()
+            # (Linked inodes must not be kept open, nor anything past matching)
+            self._file_pool.close()
 
         self.progress.clear()
+        for fsdev in self._fsdevs.values():
+            fsdev.add_bucket_stats(self.stats)
         self._prelink_inode_stats = self._inode_stats()
         for fsdev in self._fsdevs.values():
             for fileinfo_pair in fsdev.sorted_links(self.options, self.stats):
@@ -483,6 +865,298 @@ class Hardlinkable(object):
                 self.progress.show_hardlinked_amount()
         self.progress.clear()
 
+    def _found_fileinfo(self, directories):
+        # type: (List) -> Iterable[FileInfo]
+        """Yield FileInfo for all the matched files, showing the progress"""
+        for fileinfo in self.matched_fileinfo(directories):
+            self.progress.show_dirs_files_found()
+            yield fileinfo
+
+    def _ordered_fileinfo(self, directories):
+        # type: (List) -> List[FileInfo]
+        """Walk the directories, and return the FileInfo of all the matched
+        files in the physical order of their data.  The digests that the
+        file matching will need are computed up front, in the same order."""
+        fileinfos = list(self._found_fileinfo(directories))
+
+        # Only the files sharing a stat hash with another inode are ever read,
+        # so only their physical location is needed.
+        bucket_inodes = self._bucket_inodes(fileinfos)
+        locations = {}  # type: Dict[Tuple[int, int], int]
+        for fileinfo in fileinfos:
+            statinfo = fileinfo.statinfo
+            dev_ino = (statinfo.st_dev, statinfo.st_ino)
+            key = (statinfo.st_dev,) + self._inode_hash(fileinfo)
+            if dev_ino not in locations and len(bucket_inodes[key]) > 1:
+                location = _physical_offset(fileinfo.pathname())
+                locations[dev_ino] = -1 if location is None else location
+
+        def physical_order(fileinfo):
+            # type: (FileInfo) -> Tuple[int, int, int]
+            statinfo = fileinfo.statinfo
+            return (statinfo.st_dev,
+                    locations.get((statinfo.st_dev, statinfo.st_ino), -1),
+                    statinfo.st_ino)
+        fileinfos.sort(key=physical_order)
+        self._add_upfront_digests(fileinfos, bucket_inodes)
+        return fileinfos
+
+    def _hashed_fileinfo(self, directories):
+        # type: (List) -> List[FileInfo]
+        """Walk the directories, and return the FileInfo of all the matched
+        files.  The digests that the file matching will need are computed up
+        front, by the hashing processes."""
+        fileinfos = list(self._found_fileinfo(directories))
+        self._add_upfront_digests(fileinfos, self._bucket_inodes(fileinfos))
+        return fileinfos
+
+    def _bucket_inodes(self, fileinfos):
+        # type: (List[FileInfo]) -> Dict[Tuple, Set[int]]
+        """Return the inodes of each (device and) bucket key"""
+        bucket_inodes = {}  # type: Dict[Tuple, Set[int]]
+        for fileinfo in fileinfos:
+            key = (fileinfo.statinfo.st_dev,) + self._inode_hash(fileinfo)
+            bucket_inodes.setdefault(key, set()).add(fileinfo.statinfo.st_ino)
+        return bucket_inodes
+
+    def _add_upfront_digests(self, fileinfos, bucket_inodes):
+        # type: (List[FileInfo], Dict[Tuple, Set[int]]) -> None
+        """Compute the digests that the file matching will need, in the
+        order of the given FileInfo"""
+        # The file matching computes the digests of buckets that are larger
+        # than the linear search threshold, one stage at a time for the inodes
+        # whose previous stage digests were equal.
+        search_thresh = self._linear_search_thresh()
+        if search_thresh is None:
+            return
+        groups = {}  # type: Dict[Tuple, List[FileInfo]]
+        seen = set()  # type: Set[Tuple[int, int]]
+        for fileinfo in fileinfos:
+            statinfo = fileinfo.statinfo
+            key = (statinfo.st_dev,) + self._inode_hash(fileinfo)
+            dev_ino = (statinfo.st_dev, statinfo.st_ino)
+            # (Small files are matched by their content keys, not digests)
+            if (len(bucket_inodes[key]) > search_thresh + 1 and dev_ino not in seen and
+                    not self._is_small_file(statinfo)):
+                seen.add(dev_ino)
+                groups.setdefault(key, []).append(fileinfo)
+
+        hash_workers = self._hash_workers()
+        if hash_workers < 2:
+            self._add_ordered_digests(fileinfos, groups)
+            return
+        executor = _hashing_executor(hash_workers)
+        try:
+            self._add_ordered_digests(fileinfos, groups, executor, hash_workers)
+        finally:
+            _shutdown_executor(executor)
+
+    def _add_ordered_digests(self, fileinfos, groups, executor=None, num_workers=1):
+        # type: (List[FileInfo], Dict[Tuple, List[FileInfo]], Any, int) -> None
+        """Compute each digest stage for the groups of files that may be
+        equal, in the order of the given FileInfo, regrouping the files by
+        their digest after each stage.  The digests are computed by the
+        hashing processes of the executor, if given."""
+        for stage in _DIGEST_STAGES:
+            pending = set()  # type: Set[Tuple[int, int]]
+            for group in groups.values():
+                if len(group) < 2:
+                    continue
+                for fileinfo in group:
+                    if stage in self._digest_stages(fileinfo.statinfo.st_size):
+                        pending.add((fileinfo.statinfo.st_dev, fileinfo.statinfo.st_ino))
+            if not pending:
+                break
+
+            undigested = []  # type: List[FileInfo]
+            for fileinfo in fileinfos:
+                statinfo = fileinfo.statinfo
+                dev_ino = (statinfo.st_dev, statinfo.st_ino)
+                if dev_ino in pending:
+                    pending.remove(dev_ino)
+                    fsdev = self._get_fsdev(statinfo.st_dev)
+                    if statinfo.st_ino not in fsdev.stage_digests[stage]:
+                        undigested.append(fileinfo)
+            if executor is None:
+                for fileinfo in undigested:
+                    fsdev = self._get_fsdev(fileinfo.statinfo.st_dev)
+                    self._add_content_digest(fsdev, fileinfo, stage)
+            else:
+                self._add_pooled_digests(undigested, stage, executor, num_workers)
+
+            regrouped = {}  # type: Dict[Tuple, List[FileInfo]]
+            for key, group in groups.items():
+                for fileinfo in group:
+                    fsdev = self._get_fsdev(fileinfo.statinfo.st_dev)
+                    digest = fsdev.stage_digests[stage].get(fileinfo.statinfo.st_ino)
+                    if digest is not None:
+                        regrouped.setdefault(key + (digest,), []).append(fileinfo)
+            groups = regrouped
+
+    def _add_pooled_digests(self, fileinfos, stage, executor, num_workers):
+        # type: (List[FileInfo], str, Any, int) -> None
+        """Compute the given stage's digests of the files in the hashing
+        processes.  Tasks are submitted in order, with a bounded number in
+        flight, and their digests are stored as they complete."""
+        work = []  # type: List[FileInfo]
+        for fileinfo in fileinfos:
+            fsdev = self._get_fsdev(fileinfo.statinfo.st_dev)
+            if self._stored_content_digest(fsdev, fileinfo, stage) is None:
+                work.append(fileinfo)
+
+        algorithm = self._hash_algorithm()
+        max_in_flight = _HASH_TASKS_PER_WORKER * num_workers
+        in_flight = {}  # type: Dict[Any, List[FileInfo]]
+        i = 0
+        while i < len(work) or in_flight:
+            while i < len(work) and len(in_flight) < max_in_flight:
+                task = work[i:i + _HASH_TASK_FILES]
+                i += len(task)
+                items = [(x.pathname(), x.statinfo.st_size, _is_sparse(x.statinfo))
+                         for x in task]
+                future = executor.submit(_hash_files, stage, algorithm,
+                                         self.options.read_block,
+                                         self._gentle_io(), items)
+                in_flight[future] = task
+            done, not_done = _wait_futures(list(in_flight.keys()),
+                                           return_when=_FIRST_COMPLETED)
+            for future in done:
+                task = in_flight.pop(future)
+                for fileinfo, digest in zip(task, future.result()):
+                    if digest is not None:
+                        fsdev = self._get_fsdev(fileinfo.statinfo.st_dev)
+                        self._store_content_digest(fsdev, fileinfo, stage, digest)
+
+    def _match_concurrently(self, fileinfos, num_threads):
+        # type: (List[FileInfo], int) -> None
+        """Match the given files, with the independent groups of files
+        matched concurrently by a pool of threads.  Each group is matched
+        into a separate FSDev, which is merged afterwards.  The stats and
+        linked inodes of each file are replayed in the order of the files, so
+        the results are the same as matching them serially."""
+        groups = self._match_groups(fileinfos)
+        if groups is None or self._caches_may_evict(groups):
+            for fileinfo in fileinfos:
+                self._find_identical_files(fileinfo)
+            return
+
+        # Start the largest groups first, so that they don't finish last.
+        groups.sort(key=len, reverse=True)
+        executor = _ThreadPoolExecutor(max_workers=num_threads)
+        try:
+            futures = [executor.submit(self._match_group, group) for group in groups]
+            results = [future.result() for future in futures]
+        finally:
+            _shutdown_executor(executor)
+
+        recorded_calls = []  # type: List[Tuple[int, str, Tuple, Dict]]
+        linked_pairs = []  # type: List[Tuple[int, int, int, int]]
+        for fsdev, group_calls, group_pairs in results:
+            self._get_fsdev(fsdev.st_dev).merge(fsdev)
+            recorded_calls.extend(group_calls)
+            for index, ino1, ino2 in group_pairs:
+                linked_pairs.append((index, fsdev.st_dev, ino1, ino2))
+
+        # (Sorting is stable, so each file's own calls keep their order)
+        recorded_calls.sort(key=lambda x: x[0])
+        for index, name, args, kwargs in recorded_calls:
+            getattr(self.stats, name)(*args, **kwargs)
+        linked_pairs.sort(key=lambda x: x[0])
+        for index, st_dev, ino1, ino2 in linked_pairs:
+            self._get_fsdev(st_dev).add_linked_inodes(ino1, ino2)
+
+    def _match_groups(self, fileinfos):
+        # type: (List[FileInfo]) -> Optional[List[List[Tuple[int, FileInfo]]]]
+        """Return the (index, FileInfo) lists of the files that share a
+        device and stat hash, which can be matched independently of the other
+        groups.  (With --same-name, a group holds all the filename buckets,
+        since an inode is added to the bucket of each of its names.)  Returns
+        None if an inode's files have differing stat hashes, such as when it
+        was modified during the walk."""
+        groups = {}  # type: Dict[Tuple, List[Tuple[int, FileInfo]]]
+        ino_keys = {}  # type: Dict[Tuple[int, int], Tuple]
+        for index, fileinfo in enumerate(fileinfos):
+            statinfo = fileinfo.statinfo
+            key = (statinfo.st_dev,) + _stat_hash_value(statinfo, self.options)
+            if ino_keys.setdefault((statinfo.st_dev, statinfo.st_ino), key) != key:
+                return None
+            groups.setdefault(key, []).append((index, fileinfo))
+        return list(groups.values())
+
+    def _caches_may_evict(self, groups):
+        # type: (List[List[Tuple[int, FileInfo]]]) -> bool
+        """Return True if the comparison cache, block cache or file pool
+        could fill up while matching the groups.  The groups share them, and
+        each group only uses its own inodes' entries.  So unless an entry
+        can be evicted (which depends on how the threads are scheduled), what
+        they hold and count is the same as when matching serially."""
+        num_inodes = 0
+        num_pairs = 0
+        num_bytes = 0
+        for group in groups:
+            statinfos = {}  # type: Dict[int, _os.stat_result]
+            for index, fileinfo in group:
+                statinfos.setdefault(fileinfo.statinfo.st_ino, fileinfo.statinfo)
+            # (Only small files, keyed by their content, are read when alone)
+            if len(statinfos) < 2 and not self._is_small_file(group[0][1].statinfo):
+                continue
+            num_inodes += len(statinfos)
+            num_pairs += len(statinfos) * (len(statinfos) - 1) // 2
+            for statinfo in statinfos.values():
+                num_bytes += min(statinfo.st_size, _filecmp.BUFSIZE)
+        may_evict = ((0 < self._file_pool.max_files < num_inodes) or
+                     (0 < self._block_cache.max_bytes < num_bytes) or
+                     (0 < self._comparison_cache.max_size < num_pairs))
+        if may_evict and self.options.debug_level > 1:
+            _logging.debug("Matching serially, as the caches could fill up "
+                           "(inodes: %s  pairs: %s  head bytes: %s)" %
+                           (num_inodes, num_pairs, num_bytes))
+        return may_evict
+
+    def _match_group(self, group):
+        # type: (List[Tuple[int, FileInfo]]) -> Tuple[_FSDev, List, List[Tuple[int, int, int]]]
+        """Match a group of files into a detached FSDev.  Returns it, along
+        with the recorded stats calls and the linked inode pairs, each tagged
+        with the index of the file that was being matched."""
+        st_dev = group[0][1].statinfo.st_dev
+        fsdev = self._get_fsdev(st_dev).detached()
+        matcher = _copy.copy(self)
+        matcher.stats = _RecordedStats()  # type: ignore
+        matcher._fsdevs = {st_dev: fsdev}
+        linked_pairs = []  # type: List[Tuple[int, int, int]]
+        for index, fileinfo in group:
+            matcher.stats.index = index  # type: ignore
+            matcher._find_identical_files(fileinfo)
+            for ino1, ino2 in fsdev.linked_log:
+                linked_pairs.append((index, ino1, ino2))
+            del fsdev.linked_log[:]
+        return fsdev, matcher.stats.calls, linked_pairs  # type: ignore
+
+    def _open_digest_cache(self):
+        # type: () -> None
+        """Open the persistent digest cache, if one was requested"""
+        if _sqlite3 is None or not self.options.digest_cache:
+            return
+        try:
+            self._digest_cache = _DigestCache(self.options.digest_cache)
+        except _sqlite3.Error:
+            error = _sys.exc_info()[1]
+            _logging.warning("Unable to open digest cache: %s\n%s" %
+                             (self.options.digest_cache, error))
+
+    def _close_digest_cache(self):
+        # type: () -> None
+        """Write out and close the persistent digest cache (if open)"""
+        if self._digest_cache is None:
+            return
+        try:
+            self._digest_cache.close()
+        except _sqlite3.Error:
+            error = _sys.exc_info()[1]
+            _logging.warning("Unable to update digest cache: %s\n%s" %
+                             (self.options.digest_cache, error))
+        self._digest_cache = None
+
     def _find_identical_files(self, fileinfo):
         # type: (FileInfo) -> None
         """Add the given FileInfo to the internal state of which inodes are to
@@ -496,95 +1170,254 @@ class Hardlinkable(object):
 
         if ino not in fsdev.ino_stat:
             self.stats.found_inode()
-
-        inode_hash = _stat_hash_value(statinfo, options)
-        if inode_hash not in fsdev.inode_hashes:
+        else:
+            # The new file has the same inode as one we've already seen.
+            prev_namepair = fsdev.arbitrary_namepair_from_ino(ino)
+            prev_statinfo = fsdev.ino_stat[ino]
+            self.stats.found_existing_hardlink(prev_namepair, namepair, prev_statinfo)
+
+        inode_hash = self._inode_hash(fileinfo)
+        # Small files are matched by their content, as part of the bucket key.
+        # The inline content is exact, and a strong digest stands in for it
+        # (as with --hash).
+        content_key = self._inode_content_key(fsdev, fileinfo)
+        contents_known = False
+        if content_key is not None:
+            inode_hash += (content_key,)
+            contents_known = (statinfo.st_size <= options.small_file_inline or
+                              not self._verify_hash())
+        if self._xattrs_must_match():
+            inode_hash = self._xattr_bucket_key(fsdev, fileinfo, inode_hash)
+        bucket = fsdev.inode_hashes.get(inode_hash)
+        if bucket is None:
             self.stats.missed_hash()
             # Create a new entry for this hash value and store inode number.
-            fsdev.inode_hashes[inode_hash] = set([ino])
-            assert ino not in fsdev.ino_stat
+            fsdev.inode_hashes[inode_hash] = _InodeBucket(ino, fsdev.ino_digest)
+            assert options.samename or ino not in fsdev.ino_stat
         else:
             self.stats.found_hash()
-            # See if the new file has the same inode as one we've already seen.
-            if ino in fsdev.ino_stat:
-                prev_namepair = fsdev.arbitrary_namepair_from_ino(ino)
-                prev_statinfo = fsdev.ino_stat[ino]
-                self.stats.found_existing_hardlink(prev_namepair, namepair, prev_statinfo)
             # We have file(s) that have the same hash as our current file.  If
             # our inode is already cached, we might be able to use past
             # comparison work to avoid further file comparisons, by looking to
             # see if it's an inode we've already seen and linked to others.
-            inode_set = _linked_inode_set(ino, fsdev.linked_inodes)
-            found_linked_ino = (len(inode_set & fsdev.inode_hashes[inode_hash]) > 0)
+            found_linked_ino = fsdev.linked_inodes.intersects(ino, bucket)
             if not found_linked_ino:
-                cached_inodes_set = fsdev.inode_hashes[inode_hash]
-                cached_inodes_seq = cached_inodes_set  # type: Union[InoSet, List[int]]
+                cached_inodes_seq = bucket  # type: Union[_InodeBucket, List[int]]
                 # Since the cached inodes use a simple linear search, they can
                 # devolve to O(n**2) worst case, typically when contentonly
                 # option encounters a large number of same-size files.
                 #
-                # Use content hashing to hopefully shortcut the searches.  The
-                # downside is that the content hash must access the file data
-                # (not just the inode metadata), and currently only uses
-                # differences at the beginnings of files.  But it can help
-                # quickly differentiate many files with (for example) the same
-                # size, but different contents.
-                search_thresh = options.linear_search_thresh
-                use_content_digest = (search_thresh is not None and
-                                      len(cached_inodes_set) > search_thresh)
+                # Use content digests to hopefully shortcut the searches.  The
+                # downside is that the digests must access the file data (not
+                # just the inode metadata).  But they can help quickly
+                # differentiate many files with (for example) the same size,
+                # but different contents.  The bucket is sub-bucketed by the
+                # head (first 8K) digests, and only the candidates with the
+                # same head digest have their later stage digests computed:
+                # the tail (last 8K), then the sampled regions between them
+                # (for large files), then the full content (with --hash).
+                # Each stage is only computed for the candidates that survived
+                # the previous ones.
+                #
+                # With a full content hash, the digests alone determine which
+                # inodes are equal, so every candidate is digested (once).
+                #
+                # With --match-planner, the search strategy is instead chosen
+                # from the estimated costs of each.
+                strategy = None
+                if options.match_planner and content_key is None:
+                    strategy, estimated_bytes = self._planned_strategy(fsdev, fileinfo,
+                                                                       bucket)
+                    use_content_digest = strategy in (_STRATEGY_HEAD, _STRATEGY_STAGED,
+                                                      _STRATEGY_FULL)
+                    num_candidates = len(bucket)
+                    search_start = (_time.time(), self._num_bytes_read, self._num_opens)
+                else:
+                    search_thresh = self._linear_search_thresh()
+                    use_content_digest = (content_key is None and
+                                          search_thresh is not None and
+                                          len(bucket) > search_thresh)
                 if use_content_digest:
-                    digest = _content_digest(_os.path.join(*namepair))
+                    digest = fsdev.ino_digest.get(ino)
+                    if digest is None:
+                        digest = self._add_content_digest(fsdev, fileinfo)
                     # Revert to full search if digest can't be computed
                     if digest is not None:
-                        if fileinfo.statinfo.st_ino not in fsdev.inodes_with_digest:
-                            fsdev.add_content_digest(fileinfo, digest)
-                            self.stats.computed_digest()
-
-                        cached_inodes_no_digest = (cached_inodes_set -
-                                                   fsdev.inodes_with_digest)
-                        cached_inodes_same_digest = (cached_inodes_set &
-                                                     fsdev.digest_inode_map[digest])
-                        cached_inodes_different_digest = (cached_inodes_set -
-                                                          cached_inodes_same_digest -
-                                                          cached_inodes_no_digest)
-
-                        assert len(cached_inodes_same_digest &
-                                   cached_inodes_different_digest &
-                                   cached_inodes_no_digest) == 0
-
-                        # Search matching digest inos first (as they may have the
-                        # same content).  Don't search those with differing digests
-                        # at all (as they cannot be equal).
-                        cached_inodes_seq = (list(cached_inodes_same_digest) +
-                                             list(cached_inodes_no_digest))
+                        # Search matching digest inos first (as they may have
+                        # the same content).  Don't search those with
+                        # differing digests at all (as they cannot be equal).
+                        # Later digest stages narrow down the search further.
+                        stages = None
+                        if strategy == _STRATEGY_HEAD:
+                            stages = [_DIGEST_HEAD]
+                        cached_inodes_seq = self._narrowed_candidates(
+                            fsdev, fileinfo, bucket.candidates(digest), stages,
+                            len(bucket))
+
+                # The search stops at the first match, so try the likeliest
+                # matches first.
+                cached_inodes_seq = self._candidate_order.ordered(fsdev, fileinfo,
+                                                                  cached_inodes_seq)
+
+                # When several candidates must have their contents compared,
+                # compare them all at once, so the file is only read once.
+                contents_equal = {}  # type: Dict[int, bool]
+                # (Sparse files are compared pairwise, skipping their holes)
+                if (len(cached_inodes_seq) > 1 and not _is_sparse(statinfo) and
+                        not contents_known and strategy != _STRATEGY_LINEAR and
+                        (self._hash_algorithm() is None or self._verify_hash())):
+                    cached_inodes_seq = list(cached_inodes_seq)
+                    contents_equal = self._lockstep_compared(fsdev, fileinfo,
+                                                             cached_inodes_seq)
+
+                # With --gentle-io, read ahead the next candidate to compare
+                # (if it is in the file pool), while the current one is being
+                # compared.
+                readahead = (self._gentle_io() and not contents_known and
+                             (self._hash_algorithm() is None or self._verify_hash()))
+                if readahead:
+                    cached_inodes_seq = list(cached_inodes_seq)
 
                 # We did not find this file as linked to any other cached
                 # inodes yet.  So now lets see if our file should be hardlinked
                 # to any of the other files with the same hash.
                 self.stats.search_hash_list()
-                for cached_ino in cached_inodes_seq:
+                for i, cached_ino in enumerate(cached_inodes_seq):
                     self.stats.inc_hash_list_iteration()
 
                     cached_fileinfo = fsdev.fileinfo_from_ino(cached_ino)
-
+                    if readahead and i + 1 < len(cached_inodes_seq):
+                        next_ino = cached_inodes_seq[i + 1]  # type: ignore
+                        if next_ino not in contents_equal:
+                            self._file_pool.readahead(fsdev.ino_stat[next_ino],
+                                                      options.read_block)
+
+                    if contents_known:
+                        cached_equal = True  # type: Optional[bool]
+                    else:
+                        cached_equal = contents_equal.get(cached_ino)
+                    # (Pairs of head digest searches aren't staged either)
                     if self._are_files_hardlinkable(cached_fileinfo,
                                                     fileinfo,
-                                                    use_content_digest):
+                                                    (use_content_digest and
+                                                     strategy != _STRATEGY_HEAD),
+                                                    cached_equal):
                         assert cached_fileinfo.statinfo.st_dev == fsdev.st_dev
                         fsdev.add_linked_inodes(cached_ino, ino)
+                        self._candidate_order.matched(fsdev.st_dev, cached_ino)
                         break
                 else:  # nobreak
                     self.stats.no_hash_match()
                     # The file should NOT be hardlinked to any of the other
                     # files with the same hash. Add to the list of unlinked
                     # inodes for this hash value.
-                    fsdev.inode_hashes[inode_hash].add(ino)
+                    bucket.add(ino)
                     fsdev.ino_stat[ino] = statinfo
 
+                if strategy is not None:
+                    self._measured_search(fsdev, fileinfo, num_candidates, strategy,
+                                          estimated_bytes, search_start)
+
         # Always add the new file to the stored inode information
         fsdev.ino_stat[ino] = statinfo
         fsdev.ino_append_namepair(ino, fileinfo.filename, namepair)
 
+    def _inode_hash(self, fileinfo):
+        # type: (FileInfo) -> Tuple
+        """Return the bucket key of a file, shared by all the files that may
+        be linked to it"""
+        inode_hash = _stat_hash_value(fileinfo.statinfo, self.options)
+        if self.options.samename:
+            # Only files with equal names can be linked, so partition the
+            # buckets by (interned) filename.  An inode with multiple names is
+            # added to the bucket of each name.
+            inode_hash += (fileinfo.filename,)
+        return inode_hash
+
+    def _is_small_file(self, statinfo):
+        # type: (_os.stat_result) -> bool
+        """Return True if a file is matched by its content key"""
+        return 0 < statinfo.st_size <= self.options.small_file_size
+
+    def _small_file_key(self, fileinfo):
+        # type: (FileInfo) -> Optional[bytes]
+        """Return the content of a small file (or a strong digest of it, if
+        larger than --small-file-inline), for use in its bucket key.  Returns
+        None for other files, or if the content can't be read."""
+        statinfo = fileinfo.statinfo
+        if not self._is_small_file(statinfo):
+            return None
+        if statinfo.st_size <= _filecmp.BUFSIZE:
+            data = self._head_block(fileinfo)
+        else:
+            data = self._read_file_block(fileinfo, 0, statinfo.st_size)
+        # (A short read means the file has changed since it was lstat()-ed)
+        if data is None or len(data) != statinfo.st_size:
+            return None
+        self.stats.keyed_small_file()
+        if len(data) <= self.options.small_file_inline or not _HASH_ALGORITHMS:
+            return data
+        algorithm = self._hash_algorithm() or _HASH_ALGORITHMS[0]
+        return _hashlib.new(algorithm, data).digest()
+
+    def _inode_content_key(self, fsdev, fileinfo):
+        # type: (_FSDev, FileInfo) -> Optional[bytes]
+        """Return the small file content key of a file's inode.  It is only
+        read for the inode's first pathname, so that all of its pathnames are
+        keyed alike (even if a later read fails)."""
+        ino = fileinfo.statinfo.st_ino
+        if ino in fsdev.ino_content_key:
+            return fsdev.ino_content_key[ino]
+        content_key = self._small_file_key(fileinfo)
+        if self._is_small_file(fileinfo.statinfo):
+            fsdev.ino_content_key[ino] = content_key
+        return content_key
+
+    def _xattrs_must_match(self):
+        # type: () -> bool
+        """Return True if only files with equal xattrs can be linked"""
+        options = self.options
+        return (xattr is not None and not options.contentonly and
+                not options.ignore_xattr)
+
+    def _xattr_bucket_key(self, fsdev, fileinfo, inode_hash):
+        # type: (_FSDev, FileInfo, Tuple) -> Tuple
+        """Return a file's bucket key, with its xattr fingerprint added.
+        Files with differing xattrs can't be linked, so they are never
+        candidates for each other.  But the xattrs are only read once another
+        inode shares the key.  Until then, the lone inode's bucket is keyed
+        without its fingerprint."""
+        ino = fileinfo.statinfo.st_ino
+        if inode_hash not in fsdev.xattr_lone:
+            fsdev.xattr_lone[inode_hash] = fileinfo
+            return inode_hash + (_UNKEYED_XATTRS,)
+        lone_fileinfo = fsdev.xattr_lone[inode_hash]
+        if lone_fileinfo is not None:
+            if lone_fileinfo.statinfo.st_ino == ino:
+                return inode_hash + (_UNKEYED_XATTRS,)
+            # Rekey the lone inode's bucket by its fingerprint
+            fsdev.xattr_lone[inode_hash] = None
+            bucket = fsdev.inode_hashes.pop(inode_hash + (_UNKEYED_XATTRS,), None)
+            if bucket is not None:
+                lone_key = inode_hash + (self._xattr_fingerprint(lone_fileinfo),)
+                fsdev.inode_hashes[lone_key] = bucket
+        return inode_hash + (self._xattr_fingerprint(fileinfo),)
+
+    def _xattr_fingerprint(self, fileinfo):
+        # type: (FileInfo) -> Optional[Any]
+        """Return the fingerprint of a file's xattrs, read once per inode"""
+        statinfo = fileinfo.statinfo
+        fsdev = self._get_fsdev(statinfo.st_dev)
+        ino = statinfo.st_ino
+        if ino in fsdev.ino_xattr:
+            return fsdev.ino_xattr[ino]
+        fingerprint = _xattr_fingerprint(fileinfo.pathname())
+        if fingerprint is _UNREADABLE_XATTRS:
+            # Unreadable xattrs are not equal to any other inode's
+            fingerprint = (_UNREADABLE_XATTRS, statinfo.st_dev, ino)
+        fsdev.ino_xattr[ino] = fingerprint
+        return fingerprint
+
     def _hardlink_files(self, src_fileinfo, dst_fileinfo):
         # type: (FileInfo, FileInfo) -> bool
         """Actually perform the filesystem hardlinking of two files."""
@@ -642,10 +1475,19 @@ class Hardlinkable(object):
 
                 # Use the destination file times if it's most recently modified
                 dst_mtime = dst_atime = None
-                if dst_statinfo.st_mtime > src_statinfo.st_mtime:
+                dst_mtime_ns = dst_atime_ns = None
+                if _mtime_value(dst_statinfo) > _mtime_value(src_statinfo):
                     try:
-                        _os.utime(src_pathname, (dst_statinfo.st_atime,
-                                                 dst_statinfo.st_mtime))
+                        # (Nanosecond times are set exactly, when available)
+                        mtime_ns = getattr(dst_statinfo, 'st_mtime_ns', None)
+                        atime_ns = getattr(dst_statinfo, 'st_atime_ns', None)
+                        if mtime_ns is not None and atime_ns is not None:
+                            _os.utime(src_pathname, ns=(atime_ns, mtime_ns))
+                            dst_atime_ns = atime_ns
+                            dst_mtime_ns = mtime_ns
+                        else:
+                            _os.utime(src_pathname, (dst_statinfo.st_atime,
+                                                     dst_statinfo.st_mtime))
                         dst_atime = dst_statinfo.st_atime
                         dst_mtime = dst_statinfo.st_mtime
                     except Exception:
@@ -655,7 +1497,9 @@ class Hardlinkable(object):
 
                     self._updated_statinfo(src_statinfo,
                                            mtime=dst_mtime,
-                                           atime=dst_atime)
+                                           atime=dst_atime,
+                                           mtime_ns=dst_mtime_ns,
+                                           atime_ns=dst_atime_ns)
         return hardlink_succeeded
 
     def _get_fsdev(self, st_dev, max_nlinks=None):
@@ -682,49 +1526,535 @@ class Hardlinkable(object):
 
         if not options.contentonly:
             result = (result and
-                      (options.ignore_time or st1.st_mtime == st2.st_mtime) and
+                      (options.ignore_time or _mtime_value(st1) == _mtime_value(st2)) and
                       (options.ignore_perm or st1.st_mode == st2.st_mode) and
                       (st1.st_uid == st2.st_uid and st1.st_gid == st2.st_gid))
 
             if xattr is not None and not options.ignore_xattr:
-                pathname1 = fileinfo1.pathname()
-                pathname2 = fileinfo2.pathname()
-                xattr_result = _equal_xattr(pathname1, pathname2)
-                result = result and xattr_result
+                result = (result and
+                          self._xattr_fingerprint(fileinfo1) ==
+                          self._xattr_fingerprint(fileinfo2))
 
         return result
 
-    def _are_file_contents_equal(self, pathname1, pathname2):
-        # type: (str, str) -> bool
+    def _gentle_io(self):
+        # type: () -> bool
+        """Return True if content reads should avoid atime updates and page
+        cache pollution"""
+        return _posix_fadvise is not None and self.options.gentle_io
+
+    def _match_threads(self):
+        # type: () -> int
+        """Return the number of threads used to match files"""
+        if _ThreadPoolExecutor is None:
+            return 1
+        return self.options.match_threads
+
+    def _hash_workers(self):
+        # type: () -> int
+        """Return the number of processes used to compute digests"""
+        if _ProcessPoolExecutor is None:
+            return 1
+        return self.options.hash_workers
+
+    def _file_pool_size(self):
+        # type: () -> int
+        """Return the number of open files kept for reuse"""
+        if self.options.file_pool_size is not None:
+            return self.options.file_pool_size
+        max_files = _FILE_POOL_MAX
+        if _resource is not None:
+            soft_limit = _resource.getrlimit(_resource.RLIMIT_NOFILE)[0]
+            if soft_limit != _resource.RLIM_INFINITY:
+                # Each matching thread may have a lockstep comparison open
+                in_use = self._match_threads() * (_LOCKSTEP_MAX_FILES + 1)
+                max_files = min(max_files, soft_limit // 2 - in_use)
+        return max(0, max_files)
+
+    def _open_file(self, fileinfo):
+        # type: (FileInfo) -> Any
+        """Return a file opened for reading its contents, from the file pool
+        if possible.  Raises OSError (or IOError) if it can't be opened."""
+        f = self._file_pool.get(fileinfo.statinfo)
+        if f is not None:
+            self.stats.found_file_pool()
+            return f
+        self.stats.missed_file_pool()
+        if not self.options.match_planner:
+            return _open_content(fileinfo.pathname(), self._gentle_io())
+        start_time = _time.time()
+        f = _open_content(fileinfo.pathname(), self._gentle_io())
+        self._num_opens += 1
+        self._planner.opened(fileinfo.statinfo.st_dev, _time.time() - start_time)
+        return f
+
+    def _close_file(self, fileinfo, f, reusable=True):
+        # type: (FileInfo, Any, bool) -> None
+        """Return a file from _open_file() to the file pool, or close it if
+        it isn't reusable (such as after a read error)"""
+        if reusable:
+            self._file_pool.add(fileinfo.statinfo, f)
+        else:
+            _close_content(f, self._gentle_io())
+
+    def _read_file_block(self, fileinfo, offset, length):
+        # type: (FileInfo, int, int) -> Optional[bytes]
+        """Return up to length bytes of a file, from the given offset.
+        Returns None if the file can't be read."""
+        try:
+            f = self._open_file(fileinfo)
+        except (OSError, IOError):
+            return None
+        data = _read_open_block(f, offset, length)
+        self._close_file(fileinfo, f, data is not None)
+        if data is not None:
+            self._num_bytes_read += len(data)
+        return data
+
+    def _linear_search_thresh(self):
+        # type: () -> Optional[int]
+        """Return the bucket size above which content digests are used to
+        narrow the search (or None if they are not used)"""
+        # With a full content hash, every candidate is digested
+        if self._hash_algorithm() is not None:
+            return 0
+        return self.options.linear_search_thresh
+
+    def _hash_algorithm(self):
+        # type: () -> Optional[str]
+        """Return the full content hash algorithm name, if one was chosen"""
+        if not _HASH_ALGORITHMS:
+            return None
+        return self.options.hash_algorithm
+
+    def _verify_hash(self):
+        # type: () -> bool
+        """Return True if --hash matched files must also be compared"""
+        return bool(_HASH_ALGORITHMS) and self.options.verify_hash
+
+    def _add_content_digest(self, fsdev, fileinfo, stage=_DIGEST_HEAD):
+        # type: (_FSDev, FileInfo, str) -> Optional[Any]
+        """Compute and store the given stage's content digest of a file's
+        inode.  Returns None if the digest could not be computed."""
+        digest = self._stored_content_digest(fsdev, fileinfo, stage)
+        if digest is not None:
+            return digest
+
+        digest = None
+        if stage == _DIGEST_HEAD and self._block_cache.max_bytes:
+            head = self._head_block(fileinfo)
+            if head is not None:
+                digest = _block_digest(head)
+        if digest is None:
+            try:
+                f = self._open_file(fileinfo)
+            except (OSError, IOError):
+                return None
+            digest = _stage_open_digest(f, stage, fileinfo.statinfo.st_size,
+                                        self._hash_algorithm(),
+                                        self.options.read_block,
+                                        _is_sparse(fileinfo.statinfo))
+            self._close_file(fileinfo, f, digest is not None)
+            if digest is not None:
+                self._num_bytes_read += _stage_bytes_read(stage, fileinfo.statinfo.st_size)
+        if digest is not None:
+            self._store_content_digest(fsdev, fileinfo, stage, digest)
+        return digest
+
+    def _digest_algorithm(self, stage):
+        # type: (str) -> str
+        """Return the name of the algorithm used for a digest stage"""
+        if stage == _DIGEST_FULL:
+            return self._hash_algorithm()  # type: ignore
+        return 'crc32'
+
+    def _digest_cache_stage(self, stage):
+        # type: (str) -> str
+        """Return the digest cache's name for a digest stage"""
+        # Full content digests are only reusable with the same algorithm
+        if stage == _DIGEST_FULL:
+            return "%s:%s" % (stage, self._hash_algorithm())
+        return stage
+
+    def _stored_content_digest(self, fsdev, fileinfo, stage):
+        # type: (_FSDev, FileInfo, str) -> Optional[Any]
+        """Add the given stage's content digest of a file's inode, if it
+        was stored in the digest cache or xattrs.  Returns None if not."""
+        if self._digest_cache is not None:
+            digest = self._digest_cache.get(fileinfo.statinfo,
+                                            self._digest_cache_stage(stage))
+            if digest is not None:
+                self.stats.found_digest_cache()
+                fsdev.add_content_digest(fileinfo, digest, stage)
+                return digest
+            self.stats.missed_digest_cache()
+
+        if xattr is not None and self.options.digest_xattrs:
+            digest = _get_digest_xattr(fileinfo.pathname(), stage,
+                                       self._digest_algorithm(stage),
+                                       fileinfo.statinfo)
+            if digest is not None:
+                self.stats.found_digest_xattr()
+                if stage == _DIGEST_FULL:
+                    fsdev.xattr_full_digests.add(fileinfo.statinfo.st_ino)
+                fsdev.add_content_digest(fileinfo, digest, stage)
+                return digest
+        return None
+
+    def _store_content_digest(self, fsdev, fileinfo, stage, digest):
+        # type: (_FSDev, FileInfo, str, Any) -> None
+        """Add a newly computed content digest of a file's inode, and store
+        it in the digest cache and xattrs (if used)"""
+        fsdev.add_content_digest(fileinfo, digest, stage)
+        self.stats.computed_digest(stage, _stage_bytes_read(stage, fileinfo.statinfo.st_size))
+        if self._digest_cache is not None:
+            self._digest_cache.add(fileinfo.statinfo,
+                                   self._digest_cache_stage(stage), digest)
+        if xattr is not None and self.options.digest_xattrs:
+            pathname = fileinfo.pathname()
+            if (_set_digest_xattr(pathname, stage, self._digest_algorithm(stage),
+                                  fileinfo.statinfo, digest) and
+                    self._digest_cache is not None):
+                # Setting an xattr changes the inode's ctime, which would make
+                # its cached digests stale in the next run
+                try:
+                    new_statinfo = _os.lstat(pathname)
+                except OSError:
+                    return
+                self._digest_cache.changed_ctime(fileinfo.statinfo, new_statinfo)
+
+    def _digests_stand_in(self, fileinfo1, fileinfo2):
+        # type: (FileInfo, FileInfo) -> bool
+        """Return True if equal full content digests of two files can stand
+        in for comparing their contents"""
+        if self._verify_hash():
+            return False
+        fsdev = self._get_fsdev(fileinfo1.statinfo.st_dev)
+        return (fileinfo1.statinfo.st_ino not in fsdev.xattr_full_digests and
+                fileinfo2.statinfo.st_ino not in fsdev.xattr_full_digests)
+
+    def _planned_strategy(self, fsdev, fileinfo, bucket):
+        # type: (_FSDev, FileInfo, _InodeBucket) -> Tuple[str, int]
+        """Return the planner's strategy for searching a bucket for a file,
+        and the bytes it is estimated to read"""
+        statinfo = fileinfo.statinfo
+        if self._hash_algorithm() is not None:
+            # Full digests stand in for the comparisons, so are always used
+            strategies = [_STRATEGY_FULL]
+        elif _is_sparse(statinfo) or len(bucket) < 2:
+            strategies = [_STRATEGY_LINEAR, _STRATEGY_HEAD, _STRATEGY_STAGED]
+        else:
+            strategies = [_STRATEGY_NWAY, _STRATEGY_HEAD, _STRATEGY_STAGED]
+        if DEFAULT_LINEAR_SEARCH_THRESH is None:
+            # (Digests aren't available)
+            strategies = strategies[:1]
+        bucket.update_digests()
+        num_undigested = len(bucket.undigested)
+        if statinfo.st_ino not in fsdev.ino_digest:
+            num_undigested += 1
+        return self._planner.plan(statinfo.st_dev, statinfo.st_size, len(bucket),
+                                  num_undigested, strategies)
+
+    def _measured_search(self, fsdev, fileinfo, num_candidates, strategy,
+                         estimated_bytes, search_start):
+        # type: (_FSDev, FileInfo, int, str, int, Tuple[float, int, int]) -> None
+        """Count a planned search's estimated and actual bytes read, and
+        learn from its measured throughput"""
+        start_time, start_bytes, start_opens = search_start
+        elapsed = _time.time() - start_time
+        num_bytes = self._num_bytes_read - start_bytes
+        num_opens = self._num_opens - start_opens
+        self._planner.measured(fsdev.st_dev, strategy, estimated_bytes,
+                               num_bytes, num_opens, elapsed)
+        self.stats.planned_search(strategy, estimated_bytes, num_bytes)
+        if self.options.debug_level > 2:
+            _logging.debug("Planned %s search of %s candidates (size %s): "
+                           "estimated %s bytes, read %s" %
+                           (strategy, num_candidates, fileinfo.statinfo.st_size,
+                            estimated_bytes, num_bytes))
+
+    def _digest_stages(self, size):
+        # type: (int) -> List[str]
+        """Return the content digest stages used for files of a given size"""
+        stages = [_DIGEST_HEAD]
+        # The head digest already covers all the content of small files
+        if size > _filecmp.BUFSIZE:
+            stages.append(_DIGEST_TAIL)
+        sample_thresh = self.options.sample_thresh
+        if (sample_thresh is not None and size >= sample_thresh and
+                size > 2 * _filecmp.BUFSIZE):
+            stages.append(_DIGEST_SAMPLE)
+        if self._hash_algorithm() is not None:
+            stages.append(_DIGEST_FULL)
+        return stages
+
+    def _narrowed_candidates(self, fsdev, fileinfo, candidates, stages=None,
+                             num_inodes=None):
+        # type: (_FSDev, FileInfo, List[int], Optional[List[str]], Optional[int]) -> List[int]
+        """Return the candidate inodes whose digests are equal to the file's
+        at every stage (by default, all the stages used for its size).  A
+        stage is only computed for the candidates that survived the previous
+        stages (and not at all if none did).  num_inodes is the number of
+        inodes the candidates were chosen from, if some were already excluded
+        by their head digests."""
+        if stages is None:
+            stages = self._digest_stages(fileinfo.statinfo.st_size)
+        for stage in stages:
+            if not candidates:
+                break
+            ino_digest = fsdev.stage_digests[stage]
+            digest = ino_digest.get(fileinfo.statinfo.st_ino)
+            if digest is None:
+                digest = self._add_content_digest(fsdev, fileinfo, stage)
+                if digest is None:
+                    break
+
+            survivors = []
+            for cached_ino in candidates:
+                cached_digest = ino_digest.get(cached_ino)
+                if cached_digest is None:
+                    cached_fileinfo = fsdev.fileinfo_from_ino(cached_ino)
+                    cached_digest = self._add_content_digest(fsdev, cached_fileinfo, stage)
+                # Keep candidates whose digest can't be computed (they will be
+                # compared instead)
+                if cached_digest is None or cached_digest == digest:
+                    survivors.append(cached_ino)
+            self.stats.narrowed_stage_candidates(stage, len(survivors))
+            if self.options.match_planner:
+                if stage != _DIGEST_HEAD or num_inodes is None:
+                    num_inodes = len(candidates)
+                self._planner.narrowed(fsdev.st_dev, stage, num_inodes, len(survivors))
+            candidates = survivors
+        return candidates
+
+    def _staged_digests_match(self, fileinfo1, fileinfo2):
+        # type: (FileInfo, FileInfo) -> Optional[bool]
+        """Compare the head, tail, and (with --hash) full content digests of
+        two files, computing each only when the previous stage matched.
+        Returns False at the first differing stage, True if the full content
+        digests are equal, or None if the contents must be compared."""
+        fsdev = self._get_fsdev(fileinfo1.statinfo.st_dev)
+        ino1 = fileinfo1.statinfo.st_ino
+        ino2 = fileinfo2.statinfo.st_ino
+
+        stages = self._digest_stages(fileinfo1.statinfo.st_size)
+        digest1 = digest2 = None
+        for stage in stages:
+            ino_digest = fsdev.stage_digests[stage]
+            digest1 = ino_digest.get(ino1)
+            if digest1 is None:
+                digest1 = self._add_content_digest(fsdev, fileinfo1, stage)
+            digest2 = ino_digest.get(ino2)
+            if digest2 is None:
+                digest2 = self._add_content_digest(fsdev, fileinfo2, stage)
+            # Skip a stage whose digests couldn't be computed
+            if digest1 is None or digest2 is None:
+                continue
+            if digest1 != digest2:
+                return False
+
+        if stages[-1] == _DIGEST_FULL and digest1 is not None and digest2 is not None:
+            return True
+        return None
+
+    def _lockstep_compared(self, fsdev, fileinfo, candidates):
+        # type: (_FSDev, FileInfo, List[int]) -> Dict[int, bool]
+        """Compare the file's contents to all the candidate inodes' at once.
+        Returns the comparison results of the candidates that could be read,
+        stopping after the first batch of candidates with an equal file.
+        Sparse candidates are left to the pairwise comparison."""
+        contents_equal = {}  # type: Dict[int, bool]
+        for i in range(0, len(candidates), _LOCKSTEP_MAX_FILES):
+            uncompared = []  # type: List[FileInfo]
+            start = _filecmp.BUFSIZE
+            for cached_ino in candidates[i:i + _LOCKSTEP_MAX_FILES]:
+                cached_fileinfo = fsdev.fileinfo_from_ino(cached_ino)
+                if _is_sparse(cached_fileinfo.statinfo):
+                    continue
+                result = self._cached_comparison(cached_fileinfo, fileinfo)
+                if result is None:
+                    result, head_size = self._compared_head_blocks(cached_fileinfo, fileinfo)
+                    if result is None:
+                        uncompared.append(cached_fileinfo)
+                        start = min(start, head_size)
+                    else:
+                        self._record_comparison(cached_fileinfo, fileinfo, result)
+                if result is not None:
+                    contents_equal[cached_ino] = result
+
+            if uncompared:
+                results = self._lockstep_equal_files(fileinfo, uncompared, start)
+                self.stats.did_lockstep_comparison()
+                for cached_fileinfo, result in zip(uncompared, results):
+                    if result is not None:
+                        contents_equal[cached_fileinfo.statinfo.st_ino] = result
+                        self._record_comparison(cached_fileinfo, fileinfo, result)
+            if True in contents_equal.values():
+                break
+        return contents_equal
+
+    def _lockstep_equal_files(self, fileinfo, other_fileinfos, start):
+        # type: (FileInfo, List[FileInfo], int) -> List[Optional[bool]]
+        """Compare the contents of a file with several others at once, using
+        the file pool.  Returns whether each of the other files is equal (or
+        None if it couldn't be read)."""
+        try:
+            f = self._open_file(fileinfo)
+        except (OSError, IOError):
+            return [None] * len(other_fileinfos)
+        other_files = []  # type: List[Any]
+        for other_fileinfo in other_fileinfos:
+            try:
+                other_files.append(self._open_file(other_fileinfo))
+            except (OSError, IOError):
+                other_files.append(None)
+
+        results = _lockstep_open_equal(f, other_files, self.options.read_block, start)
+        self._num_bytes_read += sum([_read_since(x, start)
+                                     for x in [f] + other_files if x is not None])
+
+        self._close_file(fileinfo, f)
+        for other_fileinfo, other_f, result in zip(other_fileinfos, other_files, results):
+            if other_f is not None:
+                self._close_file(other_fileinfo, other_f, result is not None)
+        return results
+
+    def _cached_comparison(self, fileinfo1, fileinfo2):
+        # type: (FileInfo, FileInfo) -> Optional[bool]
+        """Return the cached comparison result of two files, if any"""
+        key = _ComparisonCache.key(fileinfo1.statinfo, fileinfo2.statinfo)
+        result = self._comparison_cache.get(key)
+        if result is None:
+            self.stats.missed_comparison_cache()
+        else:
+            self.stats.found_comparison_cache()
+        return result
+
+    def _record_comparison(self, fileinfo1, fileinfo2, result):
+        # type: (FileInfo, FileInfo, bool) -> None
+        """Count and cache the result of comparing two files"""
+        self.stats.did_comparison(fileinfo1.pathname(), fileinfo2.pathname(), result)
+        key = _ComparisonCache.key(fileinfo1.statinfo, fileinfo2.statinfo)
+        self._comparison_cache.add(key, result)
+
+    def _are_file_contents_equal(self, fileinfo1, fileinfo2):
+        # type: (FileInfo, FileInfo) -> bool
         """Determine if the contents of two files are equal"""
-        result = _filecmp.cmp(pathname1, pathname2, shallow=False)
-        self.stats.did_comparison(pathname1, pathname2, result)
+        result = self._cached_comparison(fileinfo1, fileinfo2)
+        if result is None:
+            result, start = self._compared_head_blocks(fileinfo1, fileinfo2)
+            if result is None:
+                result = self._file_contents_equal(fileinfo1, fileinfo2, start)
+            self._record_comparison(fileinfo1, fileinfo2, result)
+        return result
+
+    def _file_contents_equal(self, fileinfo1, fileinfo2, start):
+        # type: (FileInfo, FileInfo, int) -> bool
+        """Compare the contents of two files (from the start offset), using
+        the file pool.  Raises OSError if a file can't be read."""
+        sparse = (_is_sparse(fileinfo1.statinfo) or
+                  _is_sparse(fileinfo2.statinfo))
+        f1 = self._open_file(fileinfo1)
+        try:
+            f2 = self._open_file(fileinfo2)
+        except (OSError, IOError):
+            self._close_file(fileinfo1, f1)
+            raise
+        # Python 2.3 disallows except/finally together
+        try:
+            result = _open_contents_equal(f1, f2, self.options.read_block,
+                                          sparse, start)
+        except (OSError, IOError):
+            self._close_file(fileinfo1, f1, False)
+            self._close_file(fileinfo2, f2, False)
+            raise
+        self._num_bytes_read += _read_since(f1, start) + _read_since(f2, start)
+        self._close_file(fileinfo1, f1)
+        self._close_file(fileinfo2, f2)
         return result
 
+    def _head_block(self, fileinfo):
+        # type: (FileInfo) -> Optional[bytes]
+        """Return the first 8K of a file, from the block cache if possible
+        (otherwise it is read and cached).  Returns None if it can't be read."""
+        statinfo = fileinfo.statinfo
+        key = (statinfo.st_dev, statinfo.st_ino, 0)
+        data = self._block_cache.get(key)
+        if data is not None:
+            self.stats.found_block_cache()
+            return data
+        self.stats.missed_block_cache()
+        data = self._read_file_block(fileinfo, 0, _filecmp.BUFSIZE)
+        if data is not None:
+            self._block_cache.add(key, data)
+        return data
+
+    def _compared_head_blocks(self, fileinfo1, fileinfo2):
+        # type: (FileInfo, FileInfo) -> Tuple[Optional[bool], int]
+        """Compare the head blocks of two (non-sparse) files.  Returns the
+        comparison result if the head blocks decide it (or else None), and
+        the offset that the rest of the contents must be compared from.
+        Files that fit in the head block have it read (and cached), but
+        larger files only use head blocks that are already cached."""
+        stat1 = fileinfo1.statinfo
+        stat2 = fileinfo2.statinfo
+        size = stat1.st_size
+        if (not self._block_cache.max_bytes or size != stat2.st_size or
+                _is_sparse(stat1) or _is_sparse(stat2)):
+            return None, 0
+        if (size > _filecmp.BUFSIZE and
+                not ((stat1.st_dev, stat1.st_ino, 0) in self._block_cache and
+                     (stat2.st_dev, stat2.st_ino, 0) in self._block_cache)):
+            return None, 0
+
+        head1 = self._head_block(fileinfo1)
+        head2 = self._head_block(fileinfo2)
+        if head1 is None or head2 is None:
+            return None, 0
+        if head1 != head2:
+            return False, 0
+        # (A short head block means the file has changed; compare it all)
+        if len(head1) < min(size, _filecmp.BUFSIZE):
+            return None, 0
+        if size <= _filecmp.BUFSIZE:
+            return True, 0
+        return None, _filecmp.BUFSIZE
+
     # Determines if two files should be hard linked together.
-    def _are_files_hardlinkable(self, fileinfo1, fileinfo2, use_digest):
-        # type: (FileInfo, FileInfo, bool) -> bool
-        """Return True if file contents and stat meta-data are equal"""
+    def _are_files_hardlinkable(self, fileinfo1, fileinfo2, use_digest,
+                                contents_equal=None):
+        # type: (FileInfo, FileInfo, bool, Optional[bool]) -> bool
+        """Return True if file contents and stat meta-data are equal.  A
+        previous comparison result of the contents can be given."""
         if not self._eligible_for_hardlink(fileinfo1, fileinfo2):
+            self.stats.found_ineligible_candidate()
             result = False
         else:
             # Since we are going to read the content anyway (to compare them),
-            # there is no i/o penalty in calculating a content hash.
+            # there is little i/o penalty in calculating content hashes.  Each
+            # stage narrows down the files that must be read further.
             stat1 = fileinfo1.statinfo
             stat2 = fileinfo2.statinfo
+            digests_match = None  # type: Optional[bool]
             if use_digest:
-                fsdev = self._get_fsdev(stat1.st_dev)
-                if fileinfo1.statinfo.st_ino not in fsdev.inodes_with_digest:
-                    fsdev.add_content_digest(fileinfo1)
-                    self.stats.computed_digest()
-
-                if fileinfo2.statinfo.st_ino not in fsdev.inodes_with_digest:
-                    fsdev.add_content_digest(fileinfo2)
-                    self.stats.computed_digest()
+                digests_match = self._staged_digests_match(fileinfo1, fileinfo2)
 
             pathname1 = fileinfo1.pathname()
             pathname2 = fileinfo2.pathname()
-            result = self._are_file_contents_equal(pathname1, pathname2)
+            if digests_match is False:
+                result = False
+            elif digests_match and self._digests_stand_in(fileinfo1, fileinfo2):
+                # Full content digests stand in for the comparison.
+                self.stats.found_digest_match(pathname1, pathname2)
+                result = True
+            else:
+                # Only the full digest matches (ie. the files to be linked)
+                # are compared to verify.
+                if digests_match:
+                    self.stats.found_digest_match(pathname1, pathname2)
+                if contents_equal is None:
+                    contents_equal = self._are_file_contents_equal(fileinfo1, fileinfo2)
+                result = contents_equal
 
             if result:
                 # Record some stats when files are found to match, but stat
@@ -738,10 +2068,8 @@ class Hardlinkable(object):
                 if stat1.st_gid != stat2.st_gid:
                     self.stats.found_mismatched_gid()
                 if xattr is not None:
-                    # Slower than stat mismatch data, but only done per-matched
-                    # file
-                    xattr_result = _equal_xattr(pathname1, pathname2)
-                    if not xattr_result:
+                    if (self._xattr_fingerprint(fileinfo1) !=
+                            self._xattr_fingerprint(fileinfo2)):
                         self.stats.found_mismatched_xattr()
 
         return result
@@ -752,8 +2080,10 @@ class Hardlinkable(object):
                           mtime=None,
                           atime=None,
                           uid=None,
-                          gid=None):
-        # type: (_os.stat_result, int, float, float, int, int) -> None
+                          gid=None,
+                          mtime_ns=None,
+                          atime_ns=None):
+        # type: (_os.stat_result, int, float, float, int, int, int, int) -> None
         """Updates an ino_stat statinfo with the given values."""
         fsdev = self._get_fsdev(statinfo.st_dev)
         return fsdev.updated_statinfo(statinfo.st_ino,
@@ -761,7 +2091,9 @@ class Hardlinkable(object):
                                       mtime=mtime,
                                       atime=atime,
                                       uid=uid,
-                                      gid=gid)
+                                      gid=gid,
+                                      mtime_ns=mtime_ns,
+                                      atime_ns=atime_ns)
 
     def _inode_stats(self):
         # type: () -> Dict[str, int]
@@ -835,6 +2167,764 @@ class FileInfo(object):
         return _os.path.join(self.dirname, self.filename)
 
 
+class _LinkedInodes(object):
+    """Disjoint sets (ie. union-find) of the inodes that have been found to
+    be linkable to each other.  Each set is a class of inodes that will all
+    ultimately be linked together.  Inodes not yet linked to any others are
+    not stored."""
+    def __init__(self):
+        # type: () -> None
+        # Parent inode of each linked inode.  Roots are their own parent.
+        self.parent = {}  # type: Dict[int, int]
+
+        # All the inodes in each class, keyed by the root inode
+        self.members = {}  # type: Dict[int, List[int]]
+
+    def __contains__(self, ino):
+        # type: (int) -> bool
+        return ino in self.parent
+
+    def find(self, ino):
+        # type: (int) -> int
+        """Return the root inode of the class containing ino"""
+        parent = self.parent
+        root = parent.get(ino, ino)
+        if root == ino:
+            return ino
+        while parent[root] != root:
+            root = parent[root]
+
+        # Path compression
+        while ino != root:
+            next_ino = parent[ino]
+            parent[ino] = root
+            ino = next_ino
+        return root
+
+    def union(self, ino1, ino2):
+        # type: (int, int) -> None
+        """Join the classes of ino1 and ino2.  When the classes are of equal
+        size, ino1's root becomes the new root."""
+        root1 = self.find(ino1)
+        root2 = self.find(ino2)
+        if root1 == root2:
+            return
+        members1 = self.members.get(root1)
+        if members1 is None:
+            self.parent[root1] = root1
+            members1 = self.members[root1] = [root1]
+        members2 = self.members.get(root2)
+        if members2 is None:
+            self.parent[root2] = root2
+            members2 = self.members[root2] = [root2]
+
+        # Union by size, merging the smaller member list into the larger
+        if len(members1) < len(members2):
+            root1, root2 = root2, root1
+            members1, members2 = members2, members1
+        self.parent[root2] = root1
+        members1.extend(members2)
+        del self.members[root2]
+
+    def intersects(self, ino, inodes):
+        # type: (int, InoSet) -> bool
+        """Return True if the class containing ino intersects the inodes"""
+        root = self.find(ino)
+        # Classes are grown from a bucket inode (the first union() argument)
+        # so the root is usually the member that is in the given inodes.
+        if root in inodes:
+            return True
+        members = self.members.get(root)
+        if members is None:
+            return False
+        for member in members:
+            if member in inodes:
+                return True
+        return False
+
+    def classes(self):
+        # type: () -> Iterable[List[int]]
+        """Generate the lists of inodes in each class"""
+        for members in self.members.values():
+            yield members
+
+
+class _InodeBucket(object):
+    """The unlinked inodes that share a stat hash value.  Inodes with a known
+    content digest are kept in per-digest sub-buckets, so that only the
+    inodes which can have equal content are searched."""
+    __slots__ = 'undigested', 'digests', 'ino_digest', 'num_inodes'
+
+    def __init__(self, ino, ino_digest):
+        # type: (int, Dict[int, int]) -> None
+        self.undigested = set()  # type: InoSet
+        self.digests = {}  # type: Dict[int, InoSet]
+        # The per-inode digests of the FSDev
+        self.ino_digest = ino_digest
+        self.num_inodes = 0
+        self.add(ino)
+
+    def __len__(self):
+        # type: () -> int
+        return self.num_inodes
+
+    def __contains__(self, ino):
+        # type: (int) -> bool
+        if ino in self.undigested:
+            return True
+        digest = self.ino_digest.get(ino)
+        return digest is not None and ino in self.digests.get(digest, ())
+
+    def __iter__(self):
+        # type: () -> Iterable[int]
+        for ino in self.undigested:
+            yield ino
+        for inodes in self.digests.values():
+            for ino in inodes:
+                yield ino
+
+    def add(self, ino):
+        # type: (int) -> None
+        self.num_inodes += 1
+        digest = self.ino_digest.get(ino)
+        if digest is None:
+            self.undigested.add(ino)
+        else:
+            self.digests.setdefault(digest, set()).add(ino)
+
+    def update_digests(self):
+        # type: () -> None
+        """Move undigested inodes to their sub-bucket, if digest is now known"""
+        ino_digest = self.ino_digest
+        for ino in [ino for ino in self.undigested if ino in ino_digest]:
+            self.undigested.remove(ino)
+            self.digests.setdefault(ino_digest[ino], set()).add(ino)
+
+    def candidates(self, digest):
+        # type: (int) -> List[int]
+        """Return the inodes that may have equal content to a file with the
+        given digest.  Those with equal digests are first."""
+        self.update_digests()
+        return list(self.digests.get(digest, ())) + list(self.undigested)
+
+
+class _CandidateOrder(object):
+    """The order in which the candidate inodes of a bucket search are
+    compared to a file (the search stops at the first match).  This policy
+    keeps the bucket's arbitrary order.  Other policies rank the candidates,
+    likeliest matches first, with ties kept in the bucket's order."""
+    name = 'none'
+
+    def ordered(self, fsdev, fileinfo, candidates):
+        # type: (_FSDev, FileInfo, Iterable[int]) -> Iterable[int]
+        """Return the candidate inodes in the order they should be compared"""
+        rank = self.rank_key(fsdev, fileinfo)
+        if rank is None or len(candidates) < 2:  # type: ignore
+            return candidates
+        return sorted(candidates, key=rank)
+
+    def rank_key(self, fsdev, fileinfo):
+        # type: (_FSDev, FileInfo) -> Optional[Callable[[int], Any]]
+        """Return the sort key function of the candidate inodes (or None to
+        keep their order)"""
+        return None
+
+    def matched(self, st_dev, ino):
+        # type: (int, int) -> None
+        """Note that a candidate inode was matched"""
+        pass
+
+
+class _SameNameOrder(_CandidateOrder):
+    """Candidates with a name equal to the file's first"""
+    name = 'name'
+
+    def rank_key(self, fsdev, fileinfo):
+        # type: (_FSDev, FileInfo) -> Optional[Callable[[int], Any]]
+        filename = fileinfo.filename
+        ino_pathnames = fsdev.ino_pathnames
+        return lambda ino: filename not in ino_pathnames[ino]
+
+
+class _ParallelDirOrder(_CandidateOrder):
+    """Candidates in a directory named the same as the file's first, such as
+    the same subdirectory of another copy of a tree"""
+    name = 'dir'
+
+    def rank_key(self, fsdev, fileinfo):
+        # type: (_FSDev, FileInfo) -> Optional[Callable[[int], Any]]
+        dir_basename = _os.path.basename(fileinfo.dirname)
+        ino_pathnames = fsdev.ino_pathnames
+
+        def rank(ino):
+            # type: (int) -> bool
+            # (Only the first pathname of each of the inode's names is checked)
+            for namepairs in ino_pathnames[ino].values():
+                if _os.path.basename(namepairs[0][0]) == dir_basename:
+                    return False
+            return True
+        return rank
+
+
+class _RecentMatchOrder(_CandidateOrder):
+    """The most recently matched candidates first (ie. move-to-front)"""
+    name = 'recent'
+
+    def __init__(self):
+        # type: () -> None
+        self.num_matches = 0
+        self.match_times = {}  # type: Dict[Tuple[int, int], int]
+        # Shared by the matching threads (--match-threads)
+        self.lock = _threading.Lock()
+
+    def rank_key(self, fsdev, fileinfo):
+        # type: (_FSDev, FileInfo) -> Optional[Callable[[int], Any]]
+        st_dev = fsdev.st_dev
+        match_times = self.match_times
+        return lambda ino: -match_times.get((st_dev, ino), -1)
+
+    def matched(self, st_dev, ino):
+        # type: (int, int) -> None
+        self.lock.acquire()
+        try:
+            self.match_times[(st_dev, ino)] = self.num_matches
+            self.num_matches += 1
+        finally:
+            self.lock.release()
+
+
+class _LikelyOrder(_CandidateOrder):
+    """Candidates with the file's name first, then those in a parallel
+    directory, each most recently matched first"""
+    name = 'likely'
+
+    def __init__(self):
+        # type: () -> None
+        self.policies = [_SameNameOrder(), _ParallelDirOrder(), _RecentMatchOrder()]
+
+    def rank_key(self, fsdev, fileinfo):
+        # type: (_FSDev, FileInfo) -> Optional[Callable[[int], Any]]
+        ranks = [policy.rank_key(fsdev, fileinfo) for policy in self.policies]
+        return lambda ino: tuple([rank(ino) for rank in ranks])  # type: ignore
+
+    def matched(self, st_dev, ino):
+        # type: (int, int) -> None
+        for policy in self.policies:
+            policy.matched(st_dev, ino)
+
+
+# The candidate order policies (--candidate-order), by name
+_CANDIDATE_ORDERS = dict([(policy.name, policy)
+                          for policy in (_CandidateOrder, _SameNameOrder,
+                                         _ParallelDirOrder, _RecentMatchOrder,
+                                         _LikelyOrder)])
+
+
+class _DeviceCosts(object):
+    """The match planner's measured costs of reading from a device"""
+    def __init__(self):
+        # type: () -> None
+        self.read_rate = float(_PLANNER_READ_RATE)
+        self.open_time = _PLANNER_OPEN_TIME
+        self.survival = {}  # type: Dict[str, float]
+        # The measured ratio of actual to estimated bytes read, per strategy
+        # (lower when reads are served from the block cache, for example)
+        self.bytes_ratio = {}  # type: Dict[str, float]
+
+
+class _MatchPlanner(object):
+    """Chooses the strategy of each bucket search (--match-planner) from a
+    cost model: the bytes each strategy is estimated to read, and the files
+    it opens, weighed by each device's read throughput and open latency.
+    The throughput, open latency, fraction of candidates surviving each
+    digest stage, and the ratio of actual to estimated bytes read, are all
+    learned from the searches of the run.
+
+    Digests are computed once per inode, so the digest strategies cost less
+    as more of a bucket is digested, while comparing all the candidates
+    costs more as the bucket grows."""
+    def __init__(self, read_block):
+        # type: (int) -> None
+        self.read_block = read_block
+        self.devices = {}  # type: Dict[int, _DeviceCosts]
+        # Shared by the matching threads (--match-threads)
+        self.lock = _threading.Lock()
+
+    def costs(self, st_dev):
+        # type: (int) -> _DeviceCosts
+        costs = self.devices.get(st_dev)
+        if costs is None:
+            costs = self.devices.setdefault(st_dev, _DeviceCosts())
+        return costs
+
+    def estimate(self, st_dev, strategy, size, num_candidates, num_undigested):
+        # type: (int, str, int, int, int) -> Tuple[float, float, float]
+        """Return the estimated bytes read, files opened, and bytes compared
+        in memory, by a strategy's search"""
+        costs = self.costs(st_dev)
+        head_size = min(size, _filecmp.BUFSIZE)
+        # Differing candidates are assumed to diverge within a read block
+        compared_size = min(size, self.read_block)
+        head_survivors = num_candidates * costs.survival.get(_DIGEST_HEAD, _PLANNER_SURVIVAL)
+        if strategy in (_STRATEGY_LINEAR, _STRATEGY_NWAY):
+            num_bytes = num_candidates * compared_size
+            num_opens = num_candidates + 1
+            if strategy == _STRATEGY_LINEAR:
+                num_opens = 2 * num_candidates
+            return (num_bytes, num_opens, num_candidates * head_size)
+
+        num_bytes = num_undigested * head_size
+        num_opens = num_undigested
+        survivors = head_survivors
+        if strategy in (_STRATEGY_STAGED, _STRATEGY_FULL) and size > head_size:
+            num_bytes += head_survivors * head_size
+            num_opens += head_survivors
+            survivors *= costs.survival.get(_DIGEST_TAIL, _PLANNER_SURVIVAL)
+        if strategy == _STRATEGY_FULL:
+            num_bytes += survivors * size
+            num_opens += survivors
+        else:
+            num_bytes += survivors * compared_size
+            num_opens += survivors + 1
+        return (num_bytes, num_opens, 0.0)
+
+    def plan(self, st_dev, size, num_candidates, num_undigested, strategies):
+        # type: (int, int, int, int, List[str]) -> Tuple[str, int]
+        """Return the cheapest of the strategies, and its estimated bytes"""
+        costs = self.costs(st_dev)
+        best = None  # type: Optional[Tuple[float, str, int]]
+        for strategy in strategies:
+            num_bytes, num_opens, num_compared = self.estimate(
+                st_dev, strategy, size, num_candidates, num_undigested)
+            cost = (num_bytes * costs.bytes_ratio.get(strategy, 1.0) / costs.read_rate +
+                    num_opens * costs.open_time +
+                    num_compared / _PLANNER_COMPARE_RATE)
+            if best is None or cost < best[0]:
+                best = (cost, strategy, int(num_bytes))
+        return best[1], best[2]  # type: ignore
+
+    def _averaged(self, average, value):
+        # type: (float, float) -> float
+        return average + _PLANNER_WEIGHT * (value - average)
+
+    def opened(self, st_dev, seconds):
+        # type: (int, float) -> None
+        """Learn from the measured latency of opening a file"""
+        self.lock.acquire()
+        try:
+            costs = self.costs(st_dev)
+            costs.open_time = self._averaged(costs.open_time, seconds)
+        finally:
+            self.lock.release()
+
+    def narrowed(self, st_dev, stage, num_candidates, num_survivors):
+        # type: (int, str, int, int) -> None
+        """Learn from the candidates surviving a digest stage"""
+        if num_candidates < 1:
+            return
+        self.lock.acquire()
+        try:
+            costs = self.costs(st_dev)
+            survival = costs.survival.get(stage, _PLANNER_SURVIVAL)
+            costs.survival[stage] = self._averaged(survival,
+                                                   float(num_survivors) / num_candidates)
+        finally:
+            self.lock.release()
+
+    def measured(self, st_dev, strategy, estimated_bytes, num_bytes, num_opens,
+                 seconds):
+        # type: (int, str, int, int, int, float) -> None
+        """Learn from the measured bytes read, files opened, and time taken
+        by a search"""
+        self.lock.acquire()
+        try:
+            costs = self.costs(st_dev)
+            if estimated_bytes > 0:
+                ratio = costs.bytes_ratio.get(strategy, 1.0)
+                costs.bytes_ratio[strategy] = self._averaged(
+                    ratio, float(num_bytes) / estimated_bytes)
+            read_seconds = seconds - num_opens * costs.open_time
+            if num_bytes >= _PLANNER_MIN_BYTES and read_seconds > 0:
+                costs.read_rate = self._averaged(costs.read_rate,
+                                                 num_bytes / read_seconds)
+        finally:
+            self.lock.release()
+
+
+class _ComparisonCache(object):
+    """Bounded, least recently used cache of file content comparison results.
+    Keyed by the (dev, ino, size, mtime) of both files, so results are not
+    reused if a file has changed."""
+    def __init__(self, max_size):
+        # type: (int) -> None
+        self.max_size = max_size
+        # Shared by the matching threads (--match-threads)
+        self.lock = _threading.Lock()
+        if _OrderedDict is None:
+            self.max_size = 0
+            self.results = {}  # type: Dict[Tuple, bool]
+        else:
+            self.results = _OrderedDict()
+
+    @staticmethod
+    def key(statinfo1, statinfo2):
+        # type: (_os.stat_result, _os.stat_result) -> Tuple
+        """Return the (order independent) cache key for comparing two files"""
+        key1 = (statinfo1.st_dev, statinfo1.st_ino, statinfo1.st_size,
+                _mtime_value(statinfo1))
+        key2 = (statinfo2.st_dev, statinfo2.st_ino, statinfo2.st_size,
+                _mtime_value(statinfo2))
+        if key2 < key1:
+            key1, key2 = key2, key1
+        return (key1, key2)
+
+    def __len__(self):
+        # type: () -> int
+        return len(self.results)
+
+    def get(self, key):
+        # type: (Tuple) -> Optional[bool]
+        self.lock.acquire()
+        try:
+            result = self.results.pop(key, None)
+            if result is not None:
+                # Reinsert, making it the most recently used
+                self.results[key] = result
+        finally:
+            self.lock.release()
+        return result
+
+    def add(self, key, result):
+        # type: (Tuple, bool) -> None
+        if self.max_size < 1:
+            return
+        self.lock.acquire()
+        try:
+            self.results.pop(key, None)
+            self.results[key] = result
+            if len(self.results) > self.max_size:
+                self.results.popitem(last=False)  # type: ignore
+        finally:
+            self.lock.release()
+
+
+class _FilePool(object):
+    """Bounded, least recently used pool of files open for reading, keyed by
+    (dev, ino).  Shared by the digest and comparison engines, so that files
+    read repeatedly (such as a hot candidate) aren't reopened each time,
+    which costs a round trip on network filesystems.
+
+    A pooled file is removed from the pool while in use, and is only reused
+    if fstat() shows it is still the file of the given statinfo."""
+    def __init__(self, max_files, gentle=False):
+        # type: (int, bool) -> None
+        self.max_files = max_files
+        self.gentle = gentle
+        # Shared by the matching threads (--match-threads)
+        self.lock = _threading.Lock()
+        if _OrderedDict is None:
+            self.max_files = 0
+            self.files = {}  # type: Dict[Tuple[int, int], Any]
+        else:
+            self.files = _OrderedDict()
+
+    def __len__(self):
+        # type: () -> int
+        return len(self.files)
+
+    def get(self, statinfo):
+        # type: (_os.stat_result) -> Optional[Any]
+        """Return the pooled open file of the statinfo's inode, if any.  It
+        is no longer pooled until it is added back."""
+        self.lock.acquire()
+        try:
+            f = self.files.pop((statinfo.st_dev, statinfo.st_ino), None)
+        finally:
+            self.lock.release()
+        if f is None:
+            return None
+        try:
+            st = _os.fstat(f.fileno())
+        except OSError:
+            st = None
+        if (st is None or st.st_dev != statinfo.st_dev or
+                st.st_ino != statinfo.st_ino or
+                st.st_size != statinfo.st_size or
+                _mtime_value(st) != _mtime_value(statinfo)):
+            _close_content(f, self.gentle)
+            return None
+        return f
+
+    def add(self, statinfo, f):
+        # type: (_os.stat_result, Any) -> None
+        """Pool an open file of the statinfo's inode (closing the least
+        recently used files beyond the maximum)"""
+        if self.max_files < 1:
+            _close_content(f, self.gentle)
+            return
+        if self.gentle:
+            _drop_cached_pages(f)
+        evicted = []  # type: List[Any]
+        self.lock.acquire()
+        try:
+            old_f = self.files.pop((statinfo.st_dev, statinfo.st_ino), None)
+            if old_f is not None:
+                evicted.append(old_f)
+            self.files[(statinfo.st_dev, statinfo.st_ino)] = f
+            while len(self.files) > self.max_files:
+                evicted.append(self.files.popitem(last=False)[1])  # type: ignore
+        finally:
+            self.lock.release()
+        for old_f in evicted:
+            _close_content(old_f, self.gentle)
+
+    def readahead(self, statinfo, length):
+        # type: (_os.stat_result, int) -> None
+        """Advise that the start of the statinfo's inode will soon be read, so
+        it can be read ahead asynchronously.  Only a pooled file is advised
+        (no file is opened for it)."""
+        if _posix_fadvise is None:
+            return
+        self.lock.acquire()
+        try:
+            f = self.files.get((statinfo.st_dev, statinfo.st_ino))
+            if f is not None:
+                try:
+                    _posix_fadvise(f.fileno(), 0, length, _os.POSIX_FADV_WILLNEED)
+                except OSError:
+                    pass
+        finally:
+            self.lock.release()
+
+    def close(self):
+        # type: () -> None
+        """Close all the pooled files"""
+        self.lock.acquire()
+        try:
+            files = list(self.files.values())
+            self.files.clear()
+        finally:
+            self.lock.release()
+        for f in files:
+            _close_content(f, self.gentle)
+
+
+class _BlockCache(object):
+    """Bounded, least recently used cache of file content blocks, keyed by
+    (dev, ino, offset).  Shared by the digest and comparison engines, so that
+    the head block of a file is read once, rather than for its digest and
+    again for each comparison.  The total size of the blocks is bounded."""
+    def __init__(self, max_bytes):
+        # type: (int) -> None
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        # Shared by the matching threads (--match-threads)
+        self.lock = _threading.Lock()
+        if _OrderedDict is None:
+            self.max_bytes = 0
+            self.blocks = {}  # type: Dict[Tuple[int, int, int], bytes]
+        else:
+            self.blocks = _OrderedDict()
+
+    def __len__(self):
+        # type: () -> int
+        return len(self.blocks)
+
+    def __contains__(self, key):
+        # type: (Tuple[int, int, int]) -> bool
+        return key in self.blocks
+
+    def get(self, key):
+        # type: (Tuple[int, int, int]) -> Optional[bytes]
+        self.lock.acquire()
+        try:
+            data = self.blocks.pop(key, None)
+            if data is not None:
+                # Reinsert, making it the most recently used
+                self.blocks[key] = data
+        finally:
+            self.lock.release()
+        return data
+
+    def add(self, key, data):
+        # type: (Tuple[int, int, int], bytes) -> None
+        if len(data) > self.max_bytes:
+            return
+        self.lock.acquire()
+        try:
+            old_data = self.blocks.pop(key, None)
+            if old_data is not None:
+                self.num_bytes -= len(old_data)
+            self.blocks[key] = data
+            self.num_bytes += len(data)
+            while self.num_bytes > self.max_bytes:
+                old_key, old_data = self.blocks.popitem(last=False)  # type: ignore
+                self.num_bytes -= len(old_data)
+        finally:
+            self.lock.release()
+
+
+class _DigestCache(object):
+    """Persistent (SQLite) store of inode content digests, reused across runs.
+    A digest is only reused if the inode's size, mtime and ctime are
+    unchanged.  Writes are batched into transactions.  Stale entries are
+    deleted, as are those unused for _DIGEST_CACHE_MAX_AGE seconds.  If the
+    cache can't be read or written during the run (for example, when locked
+    by another run), it is disabled for the rest of the run."""
+    def __init__(self, pathname):
+        # type: (str) -> None
+        self.pathname = pathname
+        self.disabled = False
+        # The connection is shared by the matching threads (--match-threads)
+        self.conn = _sqlite3.connect(pathname, timeout=_DIGEST_CACHE_TIMEOUT,
+                                     check_same_thread=False)
+        self.lock = _threading.Lock()
+        self.conn.execute("CREATE TABLE IF NOT EXISTS digests ("
+                          "dev INTEGER, ino INTEGER, stage TEXT, "
+                          "size INTEGER, mtime INTEGER, ctime INTEGER, "
+                          "digest, used INTEGER, "
+                          "PRIMARY KEY (dev, ino, stage))")
+        self.conn.commit()
+        self.now = int(_time.time())
+        self.added = []  # type: List[Tuple]
+        self.used = []  # type: List[Tuple]
+        self.stale = []  # type: List[Tuple]
+        self.ctimes = []  # type: List[Tuple]
+
+    @staticmethod
+    def _stat_fields(statinfo):
+        # type: (_os.stat_result) -> Tuple
+        ctime = getattr(statinfo, 'st_ctime_ns', None)
+        if ctime is None:
+            ctime = statinfo.st_ctime
+        return (statinfo.st_size, _mtime_value(statinfo), ctime)
+
+    def get(self, statinfo, stage):
+        # type: (_os.stat_result, str) -> Optional[Any]
+        """Return the stored digest, if the inode hasn't changed"""
+        key = (statinfo.st_dev, statinfo.st_ino, stage)
+        self.lock.acquire()
+        try:
+            if self.disabled:
+                return None
+            try:
+                row = self.conn.execute("SELECT size, mtime, ctime, digest FROM digests "
+                                        "WHERE dev=? AND ino=? AND stage=?",
+                                        key).fetchone()
+            except _sqlite3.Error:
+                self._disable(_sys.exc_info()[1])
+                return None
+            if row is None:
+                return None
+            if tuple(row[:3]) != self._stat_fields(statinfo):
+                self.stale.append(key)
+                return None
+            self.used.append((self.now,) + key)
+            self._flush_if_full()
+        finally:
+            self.lock.release()
+        digest = row[3]
+        if not isinstance(digest, (int, bytes)):
+            digest = bytes(digest)
+        return digest
+
+    def add(self, statinfo, stage, digest):
+        # type: (_os.stat_result, str, Any) -> None
+        if isinstance(digest, bytes):
+            digest = _sqlite3.Binary(digest)
+        self.lock.acquire()
+        try:
+            if self.disabled:
+                return
+            self.added.append((statinfo.st_dev, statinfo.st_ino, stage) +
+                              self._stat_fields(statinfo) + (digest, self.now))
+            self._flush_if_full()
+        finally:
+            self.lock.release()
+
+    def changed_ctime(self, statinfo, new_statinfo):
+        # type: (_os.stat_result, _os.stat_result) -> None
+        """Record that only the ctime of an inode has changed (such as by
+        setting its digest xattrs), so its entries added or used in this run
+        remain valid"""
+        fields = self._stat_fields(statinfo)
+        new_fields = self._stat_fields(new_statinfo)
+        if fields[:2] != new_fields[:2] or fields[2] == new_fields[2]:
+            return
+        self.lock.acquire()
+        try:
+            if self.disabled:
+                return
+            self.ctimes.append((new_fields[2], self.now, statinfo.st_dev,
+                                statinfo.st_ino) + fields[:2])
+            self._flush_if_full()
+        finally:
+            self.lock.release()
+
+    def _disable(self, error):
+        # type: (Exception) -> None
+        """Stop using the cache for the rest of the run (the lock is held)"""
+        _logging.warning("Unable to use digest cache: %s\n%s" % (self.pathname, error))
+        self.disabled = True
+        self.added = []
+        self.used = []
+        self.stale = []
+        self.ctimes = []
+        try:
+            self.conn.rollback()
+        except _sqlite3.Error:
+            pass
+
+    def _flush_if_full(self):
+        # type: () -> None
+        if (len(self.added) + len(self.used) + len(self.stale) +
+                len(self.ctimes) >= _DIGEST_CACHE_BATCH):
+            self._flush()
+
+    def _flush(self):
+        # type: () -> None
+        """Write the pending changes in a single transaction (the lock is
+        held)"""
+        if self.disabled:
+            return
+        try:
+            self.conn.executemany("DELETE FROM digests "
+                                  "WHERE dev=? AND ino=? AND stage=?", self.stale)
+            self.conn.executemany("INSERT OR REPLACE INTO digests "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.added)
+            self.conn.executemany("UPDATE digests SET used=? "
+                                  "WHERE dev=? AND ino=? AND stage=?", self.used)
+            self.conn.executemany("UPDATE digests SET ctime=? WHERE used=? AND "
+                                  "dev=? AND ino=? AND size=? AND mtime=?",
+                                  self.ctimes)
+            self.conn.commit()
+        except _sqlite3.Error:
+            self._disable(_sys.exc_info()[1])
+            return
+        self.added = []
+        self.used = []
+        self.stale = []
+        self.ctimes = []
+
+    def flush(self):
+        # type: () -> None
+        """Write the pending changes in a single transaction"""
+        self.lock.acquire()
+        try:
+            self._flush()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        # type: () -> None
+        self.flush()
+        if not self.disabled:
+            self.conn.execute("DELETE FROM digests WHERE used < ?",
+                              (self.now - _DIGEST_CACHE_MAX_AGE,))
+            self.conn.commit()
+        self.conn.close()
+
+
 class _FSDev(object):
     """Per filesystem (ie. st_dev) operations"""
     def __init__(self, st_dev, max_nlinks):
@@ -842,30 +2932,58 @@ class _FSDev(object):
         self.st_dev = st_dev
         self.max_nlinks = max_nlinks
 
-        # For each hash value, track inode (and optionally filename)
-        self.inode_hashes = {}  # type: Dict[int, InoSet]
+        # For each hash value, track the unlinked inodes (sub-bucketed by
+        # content digest, when known)
+        self.inode_hashes = {}  # type: Dict[int, _InodeBucket]
 
-        # For each stat hash, keep a digest of the first 8K of content.  Used
-        # to reduce linear search when looking through comparable files.
-        self.digest_inode_map = {}  # type: Dict[int, InoSet]
-        self.inodes_with_digest = set()  # type: InoSet
+        # For each inode, keep a digest of the first 8K of content.  Used to
+        # reduce linear search when looking through comparable files.
+        self.ino_digest = {}  # type: Dict[int, int]
+
+        # The later stage digests (last 8K, sampled regions, and full content
+        # with --hash), only computed for inodes whose earlier stage digests
+        # matched.
+        self.stage_digests = {_DIGEST_HEAD: self.ino_digest,
+                              _DIGEST_TAIL: {},
+                              _DIGEST_SAMPLE: {},
+                              _DIGEST_FULL: {}}  # type: Dict[str, Dict[int, Any]]
+
+        # The inodes whose full content digest was read from an xattr.  Any
+        # writer of the file can set its xattrs, so these digests only narrow
+        # the search, and the contents are still compared before linking.
+        self.xattr_full_digests = set()  # type: InoSet
 
         # Keep track of per-inode stat info
         self.ino_stat = {}  # type: Dict[int, _os.stat_result]
 
+        # The content key of each small inode (see --small-file-size), or None
+        # if its content couldn't be read
+        self.ino_content_key = {}  # type: Dict[int, Optional[bytes]]
+
+        # The fingerprint of each inode's xattrs (read once per inode)
+        self.ino_xattr = {}  # type: Dict[int, Any]
+
+        # For each bucket key (without the xattr fingerprint), the file of
+        # its only inode, whose xattrs haven't been read.  None once another
+        # inode has shared the key.
+        self.xattr_lone = {}  # type: Dict[Tuple, Optional[FileInfo]]
+
         # For each inode, keep track of all the pathnames
         self.ino_pathnames = {}  # type: Dict[int, Dict[str, List[NamePair]]]
 
-        # For each linkable file pair found, add their inodes as a pair (ie.
-        # ultimately we want to "link" the inodes together).  Each pair is
-        # added twice, in each order, so that a pair can be found from either
-        # inode.
-        self.linked_inodes = {}  # type: Dict[int, InoSet]
+        # For each linkable file pair found, join their inodes into the same
+        # class (ie. ultimately we want to "link" all the inodes of a class
+        # together).
+        self.linked_inodes = _LinkedInodes()
+
+        # When matching a separate group of files (see detached()), the
+        # linked inode pairs are also logged, to be replayed in file order
+        self.linked_log = None  # type: Optional[List[Tuple[int, int]]]
 
     def sorted_links(self, options, stats):
         # type: (_Values, LinkingStats) -> Iterable[Tuple[FileInfo, FileInfo]]
         """Generates pairs of linkeable FileInfos from the linked_inodes."""
-        for linkable_set in _linkable_inode_sets(self.linked_inodes):
+        for linkable_set in self.linked_inodes.classes():
             # Decorate-sort-undecorate with st_link as primary key
             # Order inodes from greatest to least st_nlink
             nlinks_list = [(self.ino_stat[ino].st_nlink, ino) for ino in linkable_set]
@@ -981,14 +3099,18 @@ class _FSDev(object):
         return FileInfo(dirname, filename, self.ino_stat[ino])
 
     def updated_statinfo(self,
-            ino,         # type: int
-            nlink=None,  # type: Optional[int]
-            mtime=None,  # type: Optional[float]
-            atime=None,  # type: Optional[float]
-            uid=None,    # type: Optional[int]
-            gid=None,    # type: Optional[int]
+            ino,            # type: int
+            nlink=None,     # type: Optional[int]
+            mtime=None,     # type: Optional[float]
+            atime=None,     # type: Optional[float]
+            uid=None,       # type: Optional[int]
+            gid=None,       # type: Optional[int]
+            mtime_ns=None,  # type: Optional[int]
+            atime_ns=None,  # type: Optional[int]
             ):
-        """Updates an ino_stat statinfo with the given values."""
+        """Updates an ino_stat statinfo with the given values.  The
+        nanosecond times should be given along with the float times, when
+        the statinfo has them."""
         statinfo = self.ino_stat[ino]
         l = list(statinfo)  # type: ignore
         if nlink is not None:
@@ -1002,7 +3124,22 @@ class _FSDev(object):
         if gid is not None:
             l[_stat.ST_GID] = gid
 
-        new_statinfo = statinfo.__class__(l)
+        # Preserve the fields only accessible as attributes (such as the float
+        # and nanosecond times), which the sequence alone would lose.
+        extra_fields = {}
+        for name in _STAT_ATTRIBUTE_FIELDS:
+            if getattr(statinfo, name, None) is not None:
+                extra_fields[name] = getattr(statinfo, name)
+        if mtime is not None:
+            extra_fields['st_mtime'] = mtime
+        if atime is not None:
+            extra_fields['st_atime'] = atime
+        if mtime_ns is not None:
+            extra_fields['st_mtime_ns'] = mtime_ns
+        if atime_ns is not None:
+            extra_fields['st_atime_ns'] = atime_ns
+
+        new_statinfo = statinfo.__class__(l, extra_fields)
         self.ino_stat[ino] = new_statinfo
         if self.ino_stat[ino].st_nlink < 1:
             assert self.ino_stat[ino].st_nlink == 0
@@ -1012,12 +3149,33 @@ class _FSDev(object):
 
     def add_linked_inodes(self, ino1, ino2):
         # type: (int, int) -> None
-        """Adds to the dictionary of ino1 to ino2 mappings."""
+        """Joins the classes of linkable inodes for ino1 and ino2."""
         assert ino1 != ino2
-        s = self.linked_inodes.setdefault(ino1, set())
-        s.add(ino2)
-        s = self.linked_inodes.setdefault(ino2, set())
-        s.add(ino1)
+        self.linked_inodes.union(ino1, ino2)
+        if self.linked_log is not None:
+            self.linked_log.append((ino1, ino2))
+
+    def detached(self):
+        # type: () -> _FSDev
+        """Return an empty FSDev for the same device, for matching a separate
+        group of files.  It shares the content digests (and xattr
+        fingerprints) of this FSDev, and logs its linked inode pairs."""
+        fsdev = _FSDev(self.st_dev, self.max_nlinks)
+        fsdev.ino_digest = self.ino_digest
+        fsdev.stage_digests = self.stage_digests
+        fsdev.xattr_full_digests = self.xattr_full_digests
+        fsdev.ino_xattr = self.ino_xattr
+        fsdev.linked_log = []
+        return fsdev
+
+    def merge(self, fsdev):
+        # type: (_FSDev) -> None
+        """Add the buckets and inodes of a detached FSDev, whose files were
+        disjoint from this one's.  Its linked inode pairs are not added."""
+        self.inode_hashes.update(fsdev.inode_hashes)
+        self.ino_stat.update(fsdev.ino_stat)
+        self.ino_content_key.update(fsdev.ino_content_key)
+        self.ino_pathnames.update(fsdev.ino_pathnames)
 
     def move_linked_namepair(self, namepair, src_ino, dst_ino):
         # type: (NamePair, int, int) -> None
@@ -1041,19 +3199,24 @@ class _FSDev(object):
             count += len(pathnames)
         return count
 
-    def add_content_digest(self, fileinfo, digest=None):
-        # type: (FileInfo, Optional[int]) -> None
+    def add_content_digest(self, fileinfo, digest=None, stage=_DIGEST_HEAD):
+        # type: (FileInfo, Optional[Any], str) -> None
         """Store a given digest for an inode (or generate one if not provided)"""
         if digest is None:
             digest = _content_digest(fileinfo.pathname())
             if digest is None:
                 return
-        digests = self.digest_inode_map.get(digest, None)
-        if digests is None:
-            self.digest_inode_map[digest] = set([fileinfo.statinfo.st_ino])
-        else:
-            digests.add(fileinfo.statinfo.st_ino)
-        self.inodes_with_digest.add(fileinfo.statinfo.st_ino)
+        # Buckets move the inode to its (head) digest sub-bucket when next
+        # searched
+        self.stage_digests[stage][fileinfo.statinfo.st_ino] = digest
+
+    def add_bucket_stats(self, stats):
+        # type: (LinkingStats) -> None
+        """Record the occupancy of the inode hash buckets"""
+        for bucket in self.inode_hashes.values():
+            bucket.update_digests()
+            stats.found_bucket_occupancy(len(bucket.undigested),
+                                         [len(s) for s in bucket.digests.values()])
 
 
 class LinkingStats(object):
@@ -1117,6 +3280,30 @@ class LinkingStats(object):
         self.num_hash_list_searches = 0     # Times a hash list search is initiated
         self.num_list_iterations = 0        # Number of iterations over a list in inode_hashes
         self.num_digests_computed = 0       # Number of times content digest was computed
+        self.num_digest_matches = 0         # Full content digests found equal (--hash)
+        self.num_lockstep_comparisons = 0   # Comparisons of several files at once
+        self.num_comparison_cache_hits = 0  # Comparison results found in the cache
+        self.num_comparison_cache_misses = 0  # Comparison results not in the cache
+        self.num_block_cache_hits = 0       # Head blocks found in the block cache
+        self.num_block_cache_misses = 0     # Head blocks read (and cached)
+        self.num_small_files_keyed = 0      # Small files matched by content key
+        self.num_file_pool_hits = 0         # Files reused from the open file pool
+        self.num_file_pool_misses = 0       # Files opened (not in the pool)
+        self.num_digest_cache_hits = 0      # Digests reused from --digest-cache
+        self.num_digest_cache_misses = 0    # Digests not found in --digest-cache
+        self.num_digest_xattr_hits = 0      # Digests reused from --digest-xattrs
+        self.stage_digests_computed = {}    # type: Dict[str, int]
+        self.stage_bytes_read = {}          # type: Dict[str, int]
+        self.stage_survivors = {}           # type: Dict[str, int]
+        self.planned_searches = {}          # type: Dict[str, int]
+        self.planned_bytes_estimated = {}   # type: Dict[str, int]
+        self.planned_bytes_read = {}        # type: Dict[str, int]
+        self.num_ineligible_candidates = 0  # Searched inodes rejected by meta-data
+        self.num_hash_buckets = 0           # Number of inode_hashes buckets at end of walk
+        self.num_undigested_inodes = 0      # Bucket inodes without a content digest
+        self.num_digest_subbuckets = 0      # Number of per-digest sub-buckets
+        self.num_subbucket_inodes = 0       # Bucket inodes in a digest sub-bucket
+        self.max_subbucket_size = 0         # Most inodes in any digest sub-bucket
 
         # sanity checking data
         self.inode_stats = []  # type: List[Dict[str, int]]
@@ -1267,9 +3454,90 @@ class LinkingStats(object):
         # type: () -> None
         self.num_list_iterations += 1
 
-    def computed_digest(self):
-        # type: (int) -> None
+    def found_ineligible_candidate(self):
+        # type: () -> None
+        """When a searched inode cannot be linked due to inode meta-data"""
+        self.num_ineligible_candidates += 1
+
+    def computed_digest(self, stage=_DIGEST_HEAD, num_bytes=0):
+        # type: (str, int) -> None
         self.num_digests_computed += 1
+        self.stage_digests_computed[stage] = self.stage_digests_computed.get(stage, 0) + 1
+        self.stage_bytes_read[stage] = self.stage_bytes_read.get(stage, 0) + num_bytes
+
+    def narrowed_stage_candidates(self, stage, num_survivors):
+        # type: (str, int) -> None
+        """Count the searched candidates whose digest matched at a stage"""
+        self.stage_survivors[stage] = self.stage_survivors.get(stage, 0) + num_survivors
+
+    def planned_search(self, strategy, estimated_bytes, num_bytes):
+        # type: (str, int, int) -> None
+        """Count a bucket search with a planned strategy (--match-planner)"""
+        self.planned_searches[strategy] = self.planned_searches.get(strategy, 0) + 1
+        self.planned_bytes_estimated[strategy] = (
+            self.planned_bytes_estimated.get(strategy, 0) + estimated_bytes)
+        self.planned_bytes_read[strategy] = self.planned_bytes_read.get(strategy, 0) + num_bytes
+
+    def found_comparison_cache(self):
+        # type: () -> None
+        self.num_comparison_cache_hits += 1
+
+    def missed_comparison_cache(self):
+        # type: () -> None
+        self.num_comparison_cache_misses += 1
+
+    def found_block_cache(self):
+        # type: () -> None
+        self.num_block_cache_hits += 1
+
+    def missed_block_cache(self):
+        # type: () -> None
+        self.num_block_cache_misses += 1
+
+    def found_file_pool(self):
+        # type: () -> None
+        self.num_file_pool_hits += 1
+
+    def missed_file_pool(self):
+        # type: () -> None
+        self.num_file_pool_misses += 1
+
+    def keyed_small_file(self):
+        # type: () -> None
+        self.num_small_files_keyed += 1
+
+    def found_digest_cache(self):
+        # type: () -> None
+        self.num_digest_cache_hits += 1
+
+    def missed_digest_cache(self):
+        # type: () -> None
+        self.num_digest_cache_misses += 1
+
+    def found_digest_xattr(self):
+        # type: () -> None
+        self.num_digest_xattr_hits += 1
+
+    def did_lockstep_comparison(self):
+        # type: () -> None
+        self.num_lockstep_comparisons += 1
+
+    def found_digest_match(self, pathname1, pathname2):
+        # type: (str, str) -> None
+        """When full content digests match (instead of a comparison)"""
+        self.num_digest_matches += 1
+        if self.options.debug_level > 2:
+            _logging.debug("Digest equal  : %s" % pathname1)
+            _logging.debug(" to           : %s" % pathname2)
+
+    def found_bucket_occupancy(self, num_undigested, subbucket_sizes):
+        # type: (int, List[int]) -> None
+        self.num_hash_buckets += 1
+        self.num_undigested_inodes += num_undigested
+        self.num_digest_subbuckets += len(subbucket_sizes)
+        self.num_subbucket_inodes += sum(subbucket_sizes)
+        if subbucket_sizes:
+            self.max_subbucket_size = max(self.max_subbucket_size, max(subbucket_sizes))
 
     def _count_hardlinked_previously(self):
         # type: () -> int
@@ -1471,6 +3739,7 @@ class LinkingStats(object):
                    (self.num_hash_mismatches +
                     self.num_hardlinked_previously +
                     self.num_hardlinked_thisrun)))
+            print("Candidate order            : %s" % self.options.candidate_order)
             print("Total hash searches        : %s" % self.num_hash_list_searches)
             if self.num_hash_list_searches == 0:
                 avg_per_search = "N/A"  # type: Union[str, float]
@@ -1479,8 +3748,59 @@ class LinkingStats(object):
                 avg_per_search = round(raw_avg, 3)
             print("Total hash list iterations : %s  (avg per-search: %s)" %
                   (self.num_list_iterations, avg_per_search))
+            print("Total ineligible candidates: %s" % self.num_ineligible_candidates)
             print("Total equal comparisons    : %s" % self.num_equal_comparisons)
             print("Total digests computed     : %s" % self.num_digests_computed)
+            print("Total digest matches       : %s" % self.num_digest_matches)
+            print("Total lockstep comparisons : %s" % self.num_lockstep_comparisons)
+            print("Small files content keyed  : %s" % self.num_small_files_keyed)
+            print("Comparison cache hits      : %s  (misses: %s)" %
+                  (self.num_comparison_cache_hits, self.num_comparison_cache_misses))
+            print("Block cache hits           : %s  (misses: %s)" %
+                  (self.num_block_cache_hits, self.num_block_cache_misses))
+            print("File pool hits             : %s  (misses: %s)" %
+                  (self.num_file_pool_hits, self.num_file_pool_misses))
+            print("Digest cache hits          : %s  (misses: %s)" %
+                  (self.num_digest_cache_hits, self.num_digest_cache_misses))
+            print("Digest xattr hits          : %s" % self.num_digest_xattr_hits)
+            for stage in _DIGEST_STAGES:
+                if stage in self.stage_digests_computed:
+                    print("Digest stage %-4s          : %s  (bytes read: %s  survivors: %s)" %
+                          (stage, self.stage_digests_computed[stage],
+                           self.stage_bytes_read[stage],
+                           self.stage_survivors.get(stage, 0)))
+            for strategy in _STRATEGIES:
+                if strategy in self.planned_searches:
+                    print("Planned %-6s searches    : %s  (estimated bytes: %s  read: %s)" %
+                          (strategy, self.planned_searches[strategy],
+                           self.planned_bytes_estimated[strategy],
+                           self.planned_bytes_read[strategy]))
+            print("Total hash buckets         : %s  (undigested inodes: %s)" %
+                  (self.num_hash_buckets, self.num_undigested_inodes))
+            if self.num_digest_subbuckets == 0:
+                avg_per_subbucket = "N/A"  # type: Union[str, float]
+            else:
+                raw_avg = float(self.num_subbucket_inodes) / self.num_digest_subbuckets
+                avg_per_subbucket = round(raw_avg, 3)
+            print("Total digest sub-buckets   : %s  (avg inodes: %s  max: %s)" %
+                  (self.num_digest_subbuckets, avg_per_subbucket,
+                   self.max_subbucket_size))
+
+
+class _RecordedStats(object):
+    """Stands in for LinkingStats while a group of files is matched
+    concurrently.  The method calls are recorded, along with the index of the
+    file being matched, so they can be replayed in the order of the files."""
+    def __init__(self):
+        # type: () -> None
+        self.index = 0
+        self.calls = []  # type: List[Tuple[int, str, Tuple, Dict]]
+
+    def __getattr__(self, name):
+        # type: (str) -> Callable
+        def record(*args, **kwargs):
+            self.calls.append((self.index, name, args, kwargs))
+        return record
 
 
 class _Progress(object):
@@ -1583,24 +3903,289 @@ class _Progress(object):
 #################
 
 def _stat_hash_value(statinfo, options):
-    # type: (_os.stat_result, _Values) -> int
-    """Return a value appropriate for a python dict or shelve key, which can
-    differentiate files which cannot be hardlinked."""
-    size = statinfo.st_size
-    if options.ignore_time or options.contentonly:
-        value = size
+    # type: (_os.stat_result, _Values) -> Tuple
+    """Return a value appropriate for a python dict key, which differentiates
+    files which cannot be hardlinked.  Built from exactly the inode meta-data
+    that the options require to be equal, so that all inodes with an equal
+    key are eligible for linking (by meta-data)."""
+    if options.contentonly:
+        return (statinfo.st_size,)
+
+    if options.ignore_time:
+        mtime = None
+    else:
+        mtime = _mtime_value(statinfo)
+    if options.ignore_perm:
+        mode = None
     else:
-        mtime = int(statinfo.st_mtime)
-        value = size ^ mtime
+        mode = statinfo.st_mode
+
+    return (statinfo.st_size, mtime, mode, statinfo.st_uid, statinfo.st_gid)
+
+
+def _mtime_value(statinfo):
+    # type: (_os.stat_result) -> Union[int, float]
+    """Return the most precise modification time available"""
+    mtime_ns = getattr(statinfo, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        return statinfo.st_mtime
+    return mtime_ns
+
+
+class _LstatEntry(object):
+    """Minimal stand-in for os.DirEntry, for when os.scandir() is not
+    available.  Stat information is fetched with lstat() and cached."""
+    __slots__ = 'name', 'path', '_statinfo'
+
+    def __init__(self, dirpath, name):
+        # type: (str, str) -> None
+        self.name = name
+        self.path = _os.path.join(dirpath, name)
+        self._statinfo = None  # type: Optional[_os.stat_result]
+
+    def is_file(self, follow_symlinks=True):
+        # type: (bool) -> bool
+        assert not follow_symlinks
+        return _stat.S_ISREG(self.stat(follow_symlinks=False).st_mode)
+
+    def stat(self, follow_symlinks=True):
+        # type: (bool) -> _os.stat_result
+        assert not follow_symlinks
+        if self._statinfo is None:
+            self._statinfo = _os.lstat(self.path)
+        return self._statinfo
+
+
+# Classifications of the non-directory entries yielded by _scan_entries()
+_ENTRY_EXCLUDED = 0
+_ENTRY_NOT_MATCHED = 1
+_ENTRY_STAT_FAILED = 2
+_ENTRY_STAT = 3
+
+
+def _list_directory(dirpath):
+    # type: (str) -> Optional[Tuple[List[str], Set[str], List]]
+    """Return (dirnames, symlinked_dirnames, file_entries) for a directory,
+    or None if it cannot be listed.  file_entries are the os.DirEntry objects
+    of the non-directories."""
+    dirs = []  # type: List[str]
+    symlinked_dirs = set()  # type: Set[str]
+    entries = []
+    try:
+        it = _scandir(dirpath)
+    except OSError:
+        # Ignore unreadable directories, as os.walk() does by default
+        return None
+    try:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                dirs.append(entry.name)
+                try:
+                    if entry.is_symlink():
+                        symlinked_dirs.add(entry.name)
+                except OSError:
+                    pass
+            else:
+                entries.append(entry)
+    except OSError:
+        # Directory listing can fail partway through
+        pass
+    if hasattr(it, 'close'):
+        it.close()
+    return dirs, symlinked_dirs, entries
+
+
+def _scan_entries(entries, options):
+    # type: (Iterable, _Values) -> Iterable[Tuple[int, str, Any]]
+    """Yield (entry_type, filename, value) for the given directory entries,
+    where value is the statinfo (or OSError) of matched files.  Entries that
+    are known not to be regular files are skipped without a stat call.  No
+    stats are recorded here, so it can be run from walker threads."""
+    excludes = options.excludes
+    matches = options.matches
+    for entry in entries:
+        filename = entry.name
+        if _found_excluded_regex(filename, excludes):
+            yield (_ENTRY_EXCLUDED, filename, None)
+            continue
+        if not _found_matched_filename_regex(filename, matches):
+            yield (_ENTRY_NOT_MATCHED, filename, None)
+            continue
+
+        # Is it a regular file?  The directory entry type is usually known
+        # without needing a stat() call.
+        try:
+            is_regular_file = entry.is_file(follow_symlinks=False)
+        except OSError:
+            is_regular_file = True  # Let the lstat report the error
+        if not is_regular_file:
+            continue
+
+        try:
+            statinfo = entry.stat(follow_symlinks=False)
+        except OSError:
+            yield (_ENTRY_STAT_FAILED, filename, _sys.exc_info()[1])
+            continue
+        yield (_ENTRY_STAT, filename, statinfo)
+
+
+def _walk_dir_entries(top_dir, options):
+    # type: (str, _Values) -> Iterable[Tuple[str, List[str], Iterable]]
+    """Walk the directory tree (topdown, like os.walk()), yielding (dirpath,
+    dirnames, scanned_entries) tuples, where scanned_entries are from
+    _scan_entries().  The dirnames list can be modified in place to prune the
+    walk.  Symlinks to directories are listed in dirnames, but not followed."""
+    if _scandir is None:
+        for dirpath, dirs, filenames in _os.walk(top_dir, topdown=True):
+            entries = [_LstatEntry(dirpath, filename) for filename in filenames]
+            yield dirpath, dirs, _scan_entries(entries, options)
+        return
+
+    pending = [top_dir]
+    while pending:
+        dirpath = pending.pop()
+        listing = _list_directory(dirpath)
+        if listing is None:
+            continue
+        dirs, symlinked_dirs, entries = listing
+
+        yield dirpath, dirs, _scan_entries(entries, options)
+
+        # Push in reverse, so that subdirs are walked in listed order
+        for name in reversed(dirs):
+            if name not in symlinked_dirs:
+                pending.append(_os.path.join(dirpath, name))
+
+
+class _ThreadedDirWalker(object):
+    """Walks directory trees like _walk_dir_entries(), but with directory
+    listing and lstat() calls done concurrently by a pool of threads.  Helps
+    on high latency filesystems (such as NFS), where a serial walk is bound
+    by round trip times.
+
+    The results are yielded in exactly the same order as the serial walk
+    (directories that are yet to be yielded are listed in advance), so that
+    the matching and statistics are unaffected."""
+
+    # Number of file entries to lstat() per task, so that large flat
+    # directories are also processed concurrently
+    chunk_size = 256
+
+    def __init__(self, options, num_threads):
+        # type: (_Values, int) -> None
+        self.options = options
+        self.executor = _ThreadPoolExecutor(max_workers=num_threads)
+        # Bound the number of directories listed ahead of the walk
+        self.max_pending = 4 * num_threads
+        self.num_pending = 0
+
+    def walk(self, top_dir):
+        # type: (str) -> Iterable[Tuple[str, List[str], Iterable]]
+        """Same as _walk_dir_entries()"""
+        # Stack of [dirpath, future] lists.  Futures are only submitted for
+        # the top-most entries, which are the next to be walked.
+        pending = [[top_dir, None]]  # type: List[List]
+        while pending:
+            self._submit_pending(pending)
+            dirpath, future = pending.pop()
+            self.num_pending -= 1
+            listing = future.result()
+            if listing is None:
+                continue
+            dirs, symlinked_dirs, chunk_futures = listing
+
+            yield dirpath, dirs, self._chunked_results(chunk_futures)
+
+            for name in reversed(dirs):
+                if name not in symlinked_dirs:
+                    pending.append([_os.path.join(dirpath, name), None])
+
+    def close(self):
+        # type: () -> None
+        """Shutdown the thread pool (without waiting on any unneeded work)"""
+        _shutdown_executor(self.executor)
+
+    def _submit_pending(self, pending):
+        # type: (List[List]) -> None
+        """Start listing the directories to be walked next"""
+        i = len(pending) - 1
+        while i >= 0 and self.num_pending < self.max_pending:
+            item = pending[i]
+            if item[1] is None:
+                item[1] = self.executor.submit(self._scan_directory, item[0])
+                self.num_pending += 1
+            i -= 1
+
+    def _scan_directory(self, dirpath):
+        # type: (str) -> Optional[Tuple[List[str], Set[str], List]]
+        """List a directory, and lstat() its files in chunks"""
+        listing = _list_directory(dirpath)
+        if listing is None:
+            return None
+        dirs, symlinked_dirs, entries = listing
+
+        # Submit tasks for all but the first chunk, which is done here.  This
+        # task never waits on the others, so they cannot deadlock.
+        chunk_size = self.chunk_size
+        chunk_futures = []
+        for i in range(chunk_size, len(entries), chunk_size):
+            chunk = entries[i:i + chunk_size]
+            chunk_futures.append(self.executor.submit(self._scan_chunk, chunk))
+        first_chunk = self._scan_chunk(entries[:chunk_size])
+        return dirs, symlinked_dirs, [first_chunk] + chunk_futures
+
+    def _scan_chunk(self, entries):
+        # type: (List) -> List[Tuple[int, str, Any]]
+        return list(_scan_entries(entries, self.options))
+
+    def _chunked_results(self, chunk_futures):
+        # type: (List) -> Iterable[Tuple[int, str, Any]]
+        """Yield the scanned entries from each chunk, in order"""
+        for i, chunk in enumerate(chunk_futures):
+            if i > 0:
+                chunk = chunk.result()
+            for scanned_entry in chunk:
+                yield scanned_entry
+
+
+def _shutdown_executor(executor):
+    # type: (Any) -> None
+    """Shutdown a thread pool, cancelling its queued work (if possible)"""
+    try:
+        executor.shutdown(wait=True, cancel_futures=True)
+    except TypeError:
+        # cancel_futures requires Python 3.9
+        executor.shutdown(wait=True)
 
-    return value
+
+def _normalized_dirname(dirpath):
+    # type: (str) -> str
+    """Return the dirname that os.path.dirname() would give for a normalized
+    pathname of a file within dirpath."""
+    dirname = _os.path.normpath(dirpath)
+    if dirname == _os.curdir:
+        return ''
+    return dirname
+
+
+def _pathname_prefix(dirname):
+    # type: (str) -> str
+    """Return a string that can be directly prepended to a filename, giving
+    the same result as os.path.join(dirname, filename)."""
+    if not dirname or dirname.endswith(_os.sep):
+        return dirname
+    return dirname + _os.sep
 
 
 def _cull_excluded_directories(dirs, excludes):
     # type: (List[str], List[str]) -> None
     """Remove any excluded directories from dirs.
 
-    Note that it modifies dirs in place, as required by os.walk()
+    Note that it modifies dirs in place, to prune the directory walk
     """
     for dirname in dirs[:]:
         if _found_excluded_regex(dirname, excludes):
@@ -1633,58 +4218,6 @@ def _found_matched_filename_regex(name, matches):
     return False
 
 
-def _linked_inode_set(ino, linked_inodes):
-    # type: (int, Dict[int, InoSet]) -> InoSet
-    """Return set of inodes that are connected to given inode"""
-
-    if ino not in linked_inodes:
-        return set([ino])
-    remaining_inodes = linked_inodes.copy()
-    result_set = set()  # type: InoSet
-    pending = [ino]
-    while pending:
-        ino = pending.pop()
-        result_set.add(ino)
-        try:
-            connected_links = remaining_inodes.pop(ino)
-            pending.extend(connected_links)
-        except KeyError:
-            pass
-    return result_set
-
-
-# Note that this function is similar to the above, but doesn't rely upon it for
-# it's implementation.  This is partly to avoid making unnecessary copies of
-# the linked_inodes dictionary, and to keep the calling args simple.
-def _linkable_inode_sets(linked_inodes):
-    # type: (Dict[int, InoSet]) -> Iterable[InoSet]
-    """Generate sets of inodes that can be connected.  Starts with a mapping of
-    inode # keys, and set values, which are the inodes which are determined to
-    be equal (and thus linkable) to the key inode."""
-
-    remaining_inodes = linked_inodes.copy()
-    # iterate once over each inode key, building a set of it's connected
-    # inodes, by direct or indirect association
-    for start_ino in linked_inodes:
-        if start_ino not in remaining_inodes:
-            continue
-        result_set = set()  # type: InoSet
-        pending = [start_ino]
-        # We know this loop terminates because we always remove an item from
-        # the pending list, and a key from the remaining_inodes dict.  Since no
-        # additions are made to the remaining_inodes, eventually the pending
-        # list must empty.
-        while pending:
-            ino = pending.pop()
-            result_set.add(ino)
-            try:
-                connected_links = remaining_inodes.pop(ino)
-                pending.extend(connected_links)
-            except KeyError:
-                pass
-        yield result_set
-
-
 def _namepairs_per_inode(d):
     # type: (Dict[str, List[NamePair]]) -> Iterable[NamePair]
     """Yield namepairs for each value in the dictionary d"""
@@ -1769,52 +4302,569 @@ def _humanized_number_to_bytes(s):
         return multiplier * int(s)
 
 
-def _content_digest(pathname):
-    # type: (str) -> Optional[int]
+def _content_digest(pathname, offset=0, gentle=False):
+    # type: (str, int, bool) -> Optional[int]
     """Return a hash value based on all (or some) of a file"""
-    # Currently uses just the first 8K of the file (same buffer size as
-    # filecmp)
+    # Currently uses just 8K of the file, from the given offset (same buffer
+    # size as filecmp)
+
+    if DEFAULT_LINEAR_SEARCH_THRESH is None:
+        return None
+
+    byte_data = _read_block(pathname, offset, _filecmp.BUFSIZE, gentle)
+    if byte_data is None:
+        return None
+    return _block_digest(byte_data)
+
 
+def _block_digest(byte_data):
+    # type: (bytes) -> Optional[int]
+    """Return the hash value of a block of content (as _content_digest())"""
     if DEFAULT_LINEAR_SEARCH_THRESH is None:
         return None
+    return (0xFFFFFFFF & _crc32(byte_data))
+
 
+def _read_block(pathname, offset, length, gentle=False):
+    # type: (str, int, int, bool) -> Optional[bytes]
+    """Return up to length bytes of a file, from the given offset.  Returns
+    None if the file can't be read."""
     try:
-        f = open(pathname, 'rb')
-    except OSError:
+        f = _open_content(pathname, gentle)
+    except (OSError, IOError):
         return None
+    byte_data = _read_open_block(f, offset, length)
+    _close_content(f, gentle)
+    return byte_data
+
 
-    # Python 2.3 disallows except/finally together
+def _read_open_block(f, offset, length):
+    # type: (Any, int, int) -> Optional[bytes]
+    """Return up to length bytes of an open file, from the given offset.
+    Returns None if the file can't be read."""
     try:
-        byte_data = f.read(_filecmp.BUFSIZE)  # type: ignore  #BUG workaround?
-    except OSError:
-        f.close()
+        f.seek(offset)
+        return f.read(length)  # type: ignore  #BUG workaround?
+    except (OSError, IOError):
+        return None
+
+
+def _sample_offsets(size):
+    # type: (int) -> List[int]
+    """Return the offsets of the regions sampled from a file, evenly spaced
+    between its head and tail, with more regions for larger files."""
+    num_regions = min(_SAMPLE_MAX_REGIONS, max(1, size // _SAMPLE_SPACING))
+    return [size * i // (num_regions + 1) for i in range(1, num_regions + 1)]
+
+
+def _sampled_open_digest(f, size):
+    # type: (Any, int) -> Optional[int]
+    """Return a hash value of regions sampled from the interior of an open
+    file"""
+    if DEFAULT_LINEAR_SEARCH_THRESH is None:
+        return None
+
+    crc = 0
+    try:
+        for offset in _sample_offsets(size):
+            crc = _crc32(_pread(f.fileno(), _filecmp.BUFSIZE, offset), crc)
+    except (OSError, IOError):
+        return None
+
+    return (0xFFFFFFFF & crc)
+
+
+def _full_content_digest(pathname, algorithm, block_size, sparse=False,
+                         gentle=False):
+    # type: (str, str, int, bool, bool) -> Optional[bytes]
+    """Return the named hashlib algorithm's digest of an entire file.  The
+    holes of sparse files are hashed as zeros, without reading them."""
+    try:
+        f = _open_content(pathname, gentle)
+    except (OSError, IOError):
         return None
+    digest = _full_open_digest(f, algorithm, block_size, sparse)
+    _close_content(f, gentle)
+    return digest
+
+
+def _full_open_digest(f, algorithm, block_size, sparse=False):
+    # type: (Any, str, int, bool) -> Optional[bytes]
+    """Return the named hashlib algorithm's digest of an entire open file
+    (as _full_content_digest())"""
+    h = _hashlib.new(algorithm)
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    try:
+        if sparse and _SEEK_DATA is not None:
+            size = _os.fstat(f.fileno()).st_size
+            zeros = memoryview(bytearray(block_size))
+            offset = 0
+            for start, end in _data_segments(f.fileno(), size) + [(size, size)]:
+                while offset < start:
+                    n = min(block_size, start - offset)
+                    h.update(zeros[:n])
+                    offset += n
+                f.seek(start)
+                while offset < end:
+                    n = _readinto_block(f, view[:min(block_size, end - offset)])
+                    if not n:
+                        break
+                    h.update(view[:n])
+                    offset += n
+        else:
+            f.seek(0)
+            n = _readinto_block(f, view)
+            while n:
+                if n == block_size:
+                    h.update(buf)
+                else:
+                    h.update(view[:n])
+                n = _readinto_block(f, view)
+    except (OSError, IOError):
+        return None
+
+    return h.digest()
+
+
+def _stage_content_digest(pathname, stage, size, algorithm, block_size,
+                          sparse=False, gentle=False):
+    # type: (str, str, int, Optional[str], int, bool, bool) -> Optional[Any]
+    """Return the given digest stage's hash value of a file, or None if it
+    couldn't be read.  The algorithm is only used for the full digest."""
+    try:
+        f = _open_content(pathname, gentle)
+    except (OSError, IOError):
+        return None
+    digest = _stage_open_digest(f, stage, size, algorithm, block_size, sparse)
+    _close_content(f, gentle)
+    return digest
+
+
+def _stage_open_digest(f, stage, size, algorithm, block_size, sparse=False):
+    # type: (Any, str, int, Optional[str], int, bool) -> Optional[Any]
+    """Return the given digest stage's hash value of an open file (as
+    _stage_content_digest())"""
+    if stage == _DIGEST_HEAD or stage == _DIGEST_TAIL:
+        if DEFAULT_LINEAR_SEARCH_THRESH is None:
+            return None
+        offset = 0
+        if stage == _DIGEST_TAIL:
+            offset = max(0, size - _filecmp.BUFSIZE)
+        byte_data = _read_open_block(f, offset, _filecmp.BUFSIZE)
+        if byte_data is None:
+            return None
+        return _block_digest(byte_data)
+    if stage == _DIGEST_SAMPLE:
+        return _sampled_open_digest(f, size)
+    return _full_open_digest(f, algorithm, block_size, sparse)  # type: ignore
+
+
+def _stage_bytes_read(stage, size):
+    # type: (str, int) -> int
+    """Return the number of bytes read for a digest stage of a file"""
+    if stage == _DIGEST_SAMPLE:
+        return len(_sample_offsets(size)) * _filecmp.BUFSIZE
+    if stage == _DIGEST_FULL:
+        return size
+    return min(size, _filecmp.BUFSIZE)
+
+
+def _hashing_executor(num_workers):
+    # type: (int) -> Any
+    """Return a pool of hashing processes"""
+    try:
+        return _ProcessPoolExecutor(max_workers=num_workers,
+                                    initializer=_init_hash_worker)
+    except TypeError:
+        # initializer requires Python 3.7
+        return _ProcessPoolExecutor(max_workers=num_workers)
+
+
+def _init_hash_worker():
+    # type: () -> None
+    """Leave keyboard interrupts to the main process, which shuts down the
+    hashing processes"""
+    _signal.signal(_signal.SIGINT, _signal.SIG_IGN)
+
+
+def _hash_files(stage, algorithm, block_size, gentle, items):
+    # type: (str, Optional[str], int, bool, List[Tuple[str, int, bool]]) -> List[Optional[Any]]
+    """Return the digests of the (pathname, size, sparse) items, in order.
+    Run by the hashing processes."""
+    return [_stage_content_digest(pathname, stage, size, algorithm, block_size,
+                                  sparse, gentle)
+            for pathname, size, sparse in items]
+
+
+def _open_content(pathname, gentle=False):
+    # type: (str, bool) -> Any
+    """Open a file for unbuffered reading of its contents.  If gentle, don't
+    update its access time (when permitted), and advise sequential reads."""
+    if not gentle:
+        return open(pathname, 'rb', 0)
+
+    try:
+        fd = _os.open(pathname, _os.O_RDONLY | _O_NOATIME)
+    except OSError:
+        # O_NOATIME is only permitted for the file's owner (or root)
+        error = _sys.exc_info()[1]
+        if not _O_NOATIME or error.errno != _errno.EPERM:
+            raise
+        fd = _os.open(pathname, _os.O_RDONLY)
+    if _posix_fadvise is not None:
+        try:
+            _posix_fadvise(fd, 0, 0, _os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+    return _os.fdopen(fd, 'rb', 0)
+
+
+def _close_content(f, gentle=False):
+    # type: (Any, bool) -> None
+    """Close a file opened with _open_content().  If gentle, drop its pages
+    from the page cache, to not evict other processes' cached data."""
+    if gentle:
+        _drop_cached_pages(f)
     f.close()
 
-    return (0xFFFFFFFF & _crc32(byte_data))
 
+def _read_since(f, offset):
+    # type: (Any, int) -> int
+    """Return the number of bytes read from an open file since the offset
+    (or 0 if its position isn't known)"""
+    try:
+        return max(0, f.tell() - offset)
+    except (OSError, IOError):
+        return 0
 
-def _equal_xattr(pathname1, pathname2):
-    # type: (str, str) -> bool
-    x1 = xattr.xattr(pathname1)
-    x2 = xattr.xattr(pathname2)
 
-    if len(x1) != len(x2):
+def _drop_cached_pages(f):
+    # type: (Any) -> None
+    """Advise that an open file's pages can be dropped from the page cache"""
+    if _posix_fadvise is None:
+        return
+    try:
+        _posix_fadvise(f.fileno(), 0, 0, _os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+
+
+def _physical_offset(pathname):
+    # type: (str) -> Optional[int]
+    """Return the physical byte offset of the first data extent of a file,
+    or None if it is unknown"""
+    if _fcntl is None:
+        return None
+    fiemap = bytearray(_struct.pack(_FIEMAP_FORMAT, 0, 2**64 - 1, 0, 0, 1, 0) +
+                       b'\0' * _FIEMAP_EXTENT_SIZE)
+    try:
+        fd = _os.open(pathname, _os.O_RDONLY)
+        try:
+            _fcntl.ioctl(fd, _FS_IOC_FIEMAP, fiemap)
+        finally:
+            _os.close(fd)
+    except (IOError, OSError):
+        return None
+    header_size = _struct.calcsize(_FIEMAP_FORMAT)
+    num_extents = _struct.unpack_from('=I', fiemap, 20)[0]
+    if num_extents == 0:
+        return None
+    # fe_physical follows fe_logical in the first extent
+    return _struct.unpack_from('=Q', fiemap, header_size + 8)[0]
+
+
+def _is_sparse(statinfo):
+    # type: (_os.stat_result) -> bool
+    """Return True if a file has fewer blocks allocated than its size needs"""
+    blocks = getattr(statinfo, 'st_blocks', None)
+    return blocks is not None and blocks * 512 < statinfo.st_size
+
+
+def _data_segments(fd, size):
+    # type: (int, int) -> List[Tuple[int, int]]
+    """Return the (start, end) offsets of the data segments (ie. not holes)
+    of a file.  The whole file is one segment if holes can't be found."""
+    segments = []  # type: List[Tuple[int, int]]
+    offset = 0
+    while offset < size:
+        try:
+            start = _os.lseek(fd, offset, _SEEK_DATA)
+        except OSError:
+            error = _sys.exc_info()[1]
+            if error.errno == _errno.ENXIO:
+                # No data after the offset
+                break
+            return [(0, size)]
+        end = min(size, _os.lseek(fd, start, _SEEK_HOLE))
+        if end <= start:
+            break
+        segments.append((start, end))
+        offset = end
+    return segments
+
+
+def _merged_segments(segments1, segments2):
+    # type: (List[Tuple[int, int]], List[Tuple[int, int]]) -> List[Tuple[int, int]]
+    """Return the union of two lists of (start, end) segments"""
+    merged = []  # type: List[Tuple[int, int]]
+    for start, end in sorted(segments1 + segments2):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _readinto_block(f, view):
+    # type: (Any, memoryview) -> int
+    """Fill the buffer from an unbuffered file, unless the end of file is
+    reached first.  Returns the number of bytes read."""
+    size = len(view)
+    num_read = f.readinto(view)
+    if not num_read:
+        return 0
+    while num_read < size:
+        n = f.readinto(view[num_read:])
+        if not n:
+            break
+        num_read += n
+    return num_read
+
+
+def _equal_blocks(buf1, n1, buf2, n2):
+    # type: (bytearray, int, bytearray, int) -> bool
+    """Compare the first n1 and n2 bytes of two buffers"""
+    if n1 != n2:
         return False
-    for k,v in x1.iteritems():
-        if k not in x2:
-            return False
-        if v != x2[k]:
+    if n1 == len(buf1):
+        # Full blocks compare without copying
+        return buf1 == buf2
+    return buf1[:n1] == buf2[:n2]
+
+
+def _file_contents_equal(pathname1, pathname2, block_size, sparse=False,
+                         gentle=False, start=0):
+    # type: (str, str, int, bool, bool, int) -> bool
+    """Return True if the contents of the two files are equal.  The files
+    are read into preallocated buffers, rather than a new bytes object per
+    read (as filecmp does).  Raises OSError if a file can't be read.  The
+    contents before the start offset are known to be equal, and not read.
+
+    If sparse, only the data segments of either file are compared (holes
+    in both files are equal, and skipped)."""
+    f1 = _open_content(pathname1, gentle)
+    try:
+        f2 = _open_content(pathname2, gentle)
+        try:
+            return _open_contents_equal(f1, f2, block_size, sparse, start)
+        finally:
+            _close_content(f2, gentle)
+    finally:
+        _close_content(f1, gentle)
+
+
+def _open_contents_equal(f1, f2, block_size, sparse=False, start=0):
+    # type: (Any, Any, int, bool, int) -> bool
+    """Return True if the contents of the two open files are equal (as
+    _file_contents_equal())"""
+    buf1 = bytearray(block_size)
+    buf2 = bytearray(block_size)
+    view1 = memoryview(buf1)
+    view2 = memoryview(buf2)
+
+    if sparse and _SEEK_DATA is not None:
+        return _sparse_contents_equal(f1, f2, buf1, buf2)
+    f1.seek(start)
+    f2.seek(start)
+    while True:
+        n1 = _readinto_block(f1, view1)
+        n2 = _readinto_block(f2, view2)
+        if not _equal_blocks(buf1, n1, buf2, n2):
             return False
+        if n1 < block_size:
+            return True
+
+
+def _sparse_contents_equal(f1, f2, buf1, buf2):
+    # type: (Any, Any, bytearray, bytearray) -> bool
+    """Compare two open files, reading only where either has data.  Where
+    only one file has a hole, the other's data must be zeros, which is
+    usually rejected at its first block."""
+    size = _os.fstat(f1.fileno()).st_size
+    if _os.fstat(f2.fileno()).st_size != size:
+        return False
+    segments = _merged_segments(_data_segments(f1.fileno(), size),
+                                _data_segments(f2.fileno(), size))
+    block_size = len(buf1)
+    view1 = memoryview(buf1)
+    view2 = memoryview(buf2)
+    for start, end in segments:
+        f1.seek(start)
+        f2.seek(start)
+        offset = start
+        while offset < end:
+            n = min(block_size, end - offset)
+            n1 = _readinto_block(f1, view1[:n])
+            n2 = _readinto_block(f2, view2[:n])
+            if not _equal_blocks(buf1, n1, buf2, n2):
+                return False
+            if n1 < n:
+                return True
+            offset += n
     return True
 
 
-def _equal_xattr_dummy(pathname1, pathname2):
-    # type: (str, str) -> bool
+def _lockstep_equal_files(pathname, other_pathnames, block_size, gentle=False,
+                          start=0):
+    # type: (str, List[str], int, bool, int) -> List[Optional[bool]]
+    """Compare the contents of a file with several others, by reading them
+    all in lockstep blocks, from the start offset.  A file is dropped from
+    the comparison as soon as its contents diverge, so each byte is read at
+    most once.  Returns whether each of the other files is equal (or None if
+    it couldn't be read)."""
+    try:
+        f = _open_content(pathname, gentle)
+    except (OSError, IOError):
+        return [None] * len(other_pathnames)
+
+    other_files = []  # type: List[Any]
+    for other_pathname in other_pathnames:
+        try:
+            other_files.append(_open_content(other_pathname, gentle))
+        except (OSError, IOError):
+            other_files.append(None)
+
+    results = _lockstep_open_equal(f, other_files, block_size, start)
+
+    for other_f in other_files:
+        if other_f is not None:
+            _close_content(other_f, gentle)
+    _close_content(f, gentle)
+
+    return results
+
+
+def _lockstep_open_equal(f, other_files, block_size, start=0):
+    # type: (Any, List[Any], int, int) -> List[Optional[bool]]
+    """Compare the contents of an open file with several others (as
+    _lockstep_equal_files()).  Other files that are None are not compared.
+    The files are left open."""
+    results = [None] * len(other_files)  # type: List[Optional[bool]]
+    try:
+        f.seek(start)
+    except (OSError, IOError):
+        return results
+
+    others = []  # type: List[Tuple[int, Any]]
+    for i, other_f in enumerate(other_files):
+        if other_f is None:
+            continue
+        try:
+            other_f.seek(start)
+        except (OSError, IOError):
+            continue
+        others.append((i, other_f))
+
+    # Each of the other files is read into the same buffer in turn
+    buf = bytearray(block_size)
+    other_buf = bytearray(block_size)
+    view = memoryview(buf)
+    other_view = memoryview(other_buf)
+    while others:
+        try:
+            n = _readinto_block(f, view)
+        except (OSError, IOError):
+            break
+        remaining = []
+        for i, other_f in others:
+            try:
+                other_n = _readinto_block(other_f, other_view)
+            except (OSError, IOError):
+                continue
+            if not _equal_blocks(buf, n, other_buf, other_n):
+                results[i] = False
+            elif n < block_size:
+                results[i] = True
+            else:
+                remaining.append((i, other_f))
+        others = remaining
+
+    return results
+
+
+def _xattr_fingerprint(pathname):
+    # type: (str) -> Optional[Any]
+    """Return a value that is equal for files with equal xattrs: None if a
+    file has none, otherwise a strong hash over their sorted names and values
+    (or the sorted names and values themselves, without hashlib).  Returns
+    _UNREADABLE_XATTRS if they can't be read."""
+    # Stored digests (--digest-xattrs) don't count as a difference
+    try:
+        items = sorted([(k, v) for k, v in xattr.xattr(pathname).iteritems()
+                        if not k.startswith(_DIGEST_XATTR_PREFIX)])
+    except (OSError, IOError):
+        return _UNREADABLE_XATTRS
+    if not items:
+        return None
+    if not _HASH_ALGORITHMS:
+        return tuple(items)
+    # (The repr of the (str, bytes) pairs is unambiguous)
+    data = repr(items)
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8', 'backslashreplace')
+    return _hashlib.new(_HASH_ALGORITHMS[0], data).digest()
+
+
+def _digest_xattr_prefix(algorithm, statinfo):
+    # type: (str, _os.stat_result) -> str
+    """The start of a digest xattr value, recording what it was computed for"""
+    return "%s %d %s " % (algorithm, statinfo.st_size, _mtime_value(statinfo))
+
+
+def _get_digest_xattr(pathname, stage, algorithm, statinfo):
+    # type: (str, str, str, _os.stat_result) -> Optional[Any]
+    """Return the digest stored in a file's xattr, if it was computed with the
+    same algorithm, for the same file size and mtime."""
+    try:
+        value = xattr.xattr(pathname).get(_DIGEST_XATTR_PREFIX + stage)
+    except (OSError, IOError, KeyError):
+        return None
+    value = value.decode('ascii', 'replace')
+    prefix = _digest_xattr_prefix(algorithm, statinfo)
+    if not value.startswith(prefix):
+        return None
+    try:
+        if algorithm == 'crc32':
+            return int(value[len(prefix):], 16)
+        return _binascii.unhexlify(value[len(prefix):].encode('ascii'))
+    except (ValueError, TypeError, _binascii.Error):
+        return None
+
+
+def _set_digest_xattr(pathname, stage, algorithm, statinfo, digest):
+    # type: (str, str, str, _os.stat_result, Any) -> bool
+    """Store a digest in a file's xattr.  Returns False if it couldn't be
+    stored (failures are otherwise ignored)."""
+    if algorithm == 'crc32':
+        digest_str = "%x" % digest
+    else:
+        digest_str = _binascii.hexlify(digest).decode('ascii')
+    value = _digest_xattr_prefix(algorithm, statinfo) + digest_str
+    try:
+        xattr.xattr(pathname).set(_DIGEST_XATTR_PREFIX + stage, value.encode('ascii'))
+    except (OSError, IOError):
+        _logging.debug("Unable to set digest xattr on: %s" % pathname)
+        return False
     return True
 
+
+def _xattr_fingerprint_dummy(pathname):
+    # type: (str) -> Optional[Any]
+    return None
+
 if xattr is None:
-    _equal_xattr = _equal_xattr_dummy
+    _xattr_fingerprint = _xattr_fingerprint_dummy
 
 
 def _missing_modules_str():
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import errno
+import filecmp
 import os
 import os.path
 import random
@@ -83,6 +84,245 @@ class TestModuleFunctions(unittest.TestCase):
         self.assertRaises(ValueError, f, "k")
 
 
+    def test_stat_hash_value(self):
+        f = hardlinkable._stat_hash_value
+        options = hardlinkable.get_default_parser_options()
+        st1 = os.stat_result((0o100644, 1, 1, 1, 1000, 1000, 10, 0, 5, 0),
+                             {'st_mtime_ns': 5000000001})
+        st2 = os.stat_result((0o100600, 2, 1, 1, 1000, 1000, 10, 0, 5, 0),
+                             {'st_mtime_ns': 5000000002})
+        st3 = os.stat_result((0o100644, 3, 1, 1, 1001, 1000, 10, 0, 5, 0),
+                             {'st_mtime_ns': 5000000001})
+        # Sizes and mtimes that collided with the old size^mtime hash
+        st4 = os.stat_result((0o100644, 4, 1, 1, 1000, 1000, 11, 0, 4, 0),
+                             {'st_mtime_ns': 4000000000})
+        self.assertNotEqual(f(st1, options), f(st2, options))
+        self.assertNotEqual(f(st1, options), f(st3, options))
+        self.assertNotEqual(f(st1, options), f(st4, options))
+
+        options.ignore_time = True
+        options.ignore_perm = True
+        self.assertEqual(f(st1, options), f(st2, options))
+        self.assertNotEqual(f(st1, options), f(st3, options))
+
+        options.contentonly = True
+        self.assertEqual(f(st1, options), f(st3, options))
+        self.assertNotEqual(f(st1, options), f(st4, options))
+
+    def test_sample_offsets(self):
+        f = hardlinkable._sample_offsets
+        MiB = 1024 * 1024
+        self.assertEqual(f(MiB), [MiB // 2])
+        self.assertEqual(f(48 * MiB), [12 * MiB, 24 * MiB, 36 * MiB])
+        self.assertEqual(len(f(100 * 1024 * MiB)), hardlinkable._SAMPLE_MAX_REGIONS)
+
+    def test_sparse_file_contents(self):
+        tempdir = tempfile.mkdtemp()
+        size = 1024 * 1024
+        # (offset, data) written to each file, the rest being holes
+        layouts = [[(0, b"a" * 10), (512 * 1024, b"b" * 10)],
+                   [(0, b"a" * 10), (512 * 1024, b"b" * 10)],
+                   [(0, b"a" * 10), (512 * 1024, b"c" * 10)],
+                   [(0, b"a" * 10), (512 * 1024, b"b" * 10), (900 * 1024, b"\0" * 4096)]]
+        pathnames = []
+        for i, layout in enumerate(layouts):
+            pathname = os.path.join(tempdir, str(i))
+            with open(pathname, "wb") as fp:
+                fp.truncate(size)
+                for offset, data in layout:
+                    fp.seek(offset)
+                    fp.write(data)
+            pathnames.append(pathname)
+        # The same content without holes
+        dense = bytearray(size)
+        dense[0:10] = b"a" * 10
+        dense[512 * 1024:512 * 1024 + 10] = b"b" * 10
+        pathname = os.path.join(tempdir, "dense")
+        with open(pathname, "wb") as fp:
+            fp.write(dense)
+        pathnames.append(pathname)
+        try:
+            f = hardlinkable._file_contents_equal
+            for sparse in (False, True):
+                self.assertTrue(f(pathnames[0], pathnames[1], 4096, sparse))
+                self.assertFalse(f(pathnames[0], pathnames[2], 4096, sparse))
+                # Different hole layouts, with the same content
+                self.assertTrue(f(pathnames[0], pathnames[3], 4096, sparse))
+                self.assertTrue(f(pathnames[0], pathnames[4], 4096, sparse))
+                self.assertFalse(f(pathnames[2], pathnames[4], 4096, sparse))
+
+            if hardlinkable._HASH_ALGORITHMS:
+                digest = hardlinkable._full_content_digest
+                algorithm = hardlinkable._HASH_ALGORITHMS[0]
+                self.assertEqual(digest(pathnames[0], algorithm, 4096, True),
+                                 digest(pathnames[4], algorithm, 4096, False))
+                self.assertEqual(digest(pathnames[3], algorithm, 4096, True),
+                                 digest(pathnames[4], algorithm, 4096, False))
+                self.assertNotEqual(digest(pathnames[2], algorithm, 4096, True),
+                                    digest(pathnames[4], algorithm, 4096, False))
+        finally:
+            for pathname in pathnames:
+                os.unlink(pathname)
+            os.rmdir(tempdir)
+
+    def test_file_contents_equal(self):
+        f = hardlinkable._file_contents_equal
+        tempdir = tempfile.mkdtemp()
+        contents = ["", "abcdefgh", "abcdefgh", "abcdefgX", "abcdefghi"]
+        pathnames = []
+        for i, data in enumerate(contents):
+            pathname = os.path.join(tempdir, str(i))
+            with open(pathname, "w") as fp:
+                fp.write(data)
+            pathnames.append(pathname)
+        try:
+            # Block sizes that divide the files evenly, and those that don't
+            for block_size in (1, 3, 4, 8, 1024):
+                for i, pathname1 in enumerate(pathnames):
+                    for j, pathname2 in enumerate(pathnames):
+                        self.assertEqual(f(pathname1, pathname2, block_size),
+                                         contents[i] == contents[j])
+                self.assertEqual(hardlinkable._lockstep_equal_files(
+                                     pathnames[1], pathnames, block_size),
+                                 [False, True, True, False, False])
+        finally:
+            for pathname in pathnames:
+                os.unlink(pathname)
+            os.rmdir(tempdir)
+
+
+class TestLinkedInodes(unittest.TestCase):
+    def test_union_find(self):
+        linked = hardlinkable._LinkedInodes()
+        self.assertFalse(1 in linked)
+        self.assertEqual(linked.find(1), 1)
+
+        linked.union(1, 2)
+        linked.union(3, 4)
+        linked.union(1, 5)
+        self.assertTrue(2 in linked)
+        self.assertEqual(linked.find(2), linked.find(5))
+        self.assertNotEqual(linked.find(1), linked.find(3))
+
+        linked.union(4, 5)
+        classes = [sorted(members) for members in linked.classes()]
+        self.assertEqual(classes, [[1, 2, 3, 4, 5]])
+
+    def test_intersects(self):
+        linked = hardlinkable._LinkedInodes()
+        linked.union(10, 11)
+        linked.union(10, 12)
+        self.assertTrue(linked.intersects(12, set([10, 20])))
+        self.assertTrue(linked.intersects(10, set([11])))
+        self.assertFalse(linked.intersects(11, set([20, 21])))
+        self.assertTrue(linked.intersects(20, set([20])))
+        self.assertFalse(linked.intersects(20, set([10])))
+
+
+class TestInodeBucket(unittest.TestCase):
+    def test_digest_subbuckets(self):
+        ino_digest = {}
+        bucket = hardlinkable._InodeBucket(1, ino_digest)
+        bucket.add(2)
+        ino_digest[3] = 0xabc
+        bucket.add(3)
+        self.assertEqual(len(bucket), 3)
+        self.assertEqual(sorted(bucket), [1, 2, 3])
+        self.assertTrue(3 in bucket)
+        self.assertFalse(4 in bucket)
+
+        # Undigested inodes are moved into sub-buckets once digest is known
+        ino_digest[1] = 0xabc
+        ino_digest[2] = 0xdef
+        self.assertEqual(sorted(bucket.candidates(0xabc)), [1, 3])
+        self.assertEqual(bucket.candidates(0xdef), [2])
+        self.assertEqual(bucket.candidates(0x123), [])
+        self.assertEqual(len(bucket.undigested), 0)
+        self.assertTrue(1 in bucket)
+        self.assertEqual(len(bucket), 3)
+
+
+class TestComparisonCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        st = [os.stat_result((0o100644, ino, 1, 1, 1000, 1000, 10, 0, 5, 0))
+              for ino in range(4)]
+        key = hardlinkable._ComparisonCache.key
+        self.assertEqual(key(st[0], st[1]), key(st[1], st[0]))
+
+        cache = hardlinkable._ComparisonCache(2)
+        cache.add(key(st[0], st[1]), True)
+        cache.add(key(st[0], st[2]), False)
+        self.assertEqual(cache.get(key(st[1], st[0])), True)
+        cache.add(key(st[0], st[3]), False)
+
+        # The least recently used result was evicted
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(key(st[0], st[2])), None)
+        self.assertEqual(cache.get(key(st[0], st[1])), True)
+        self.assertEqual(cache.get(key(st[0], st[3])), False)
+
+        # A changed file doesn't reuse the result
+        changed = os.stat_result((0o100644, 1, 1, 1, 1000, 1000, 10, 0, 6, 0))
+        self.assertEqual(cache.get(key(st[0], changed)), None)
+
+
+class TestFilePool(unittest.TestCase):
+    def test_lru_and_verification(self):
+        tempdir = tempfile.mkdtemp()
+        pathnames = []
+        for i in range(3):
+            pathname = os.path.join(tempdir, str(i))
+            with open(pathname, "w") as fp:
+                fp.write("abcdefgh")
+            pathnames.append(pathname)
+        try:
+            st = [os.lstat(pathname) for pathname in pathnames]
+            pool = hardlinkable._FilePool(2)
+            for i in range(3):
+                pool.add(st[i], hardlinkable._open_content(pathnames[i]))
+
+            # The least recently used file was closed
+            self.assertEqual(len(pool), 2)
+            self.assertEqual(pool.get(st[0]), None)
+            f = pool.get(st[1])
+            self.assertEqual(f.read(), b"abcdefgh")
+            self.assertEqual(pool.get(st[1]), None)
+            pool.add(st[1], f)
+
+            # A file changed since it was lstat()-ed isn't reused
+            with open(pathnames[2], "a") as fp:
+                fp.write("i")
+            self.assertEqual(pool.get(st[2]), None)
+            self.assertEqual(len(pool), 1)
+            pool.close()
+            self.assertEqual(len(pool), 0)
+            self.assertTrue(f.closed)
+        finally:
+            for pathname in pathnames:
+                os.unlink(pathname)
+            os.rmdir(tempdir)
+
+
+class TestBlockCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = hardlinkable._BlockCache(10)
+        cache.add((1, 1, 0), b"abcd")
+        cache.add((1, 2, 0), b"efgh")
+        self.assertEqual(cache.get((1, 1, 0)), b"abcd")
+        cache.add((1, 3, 0), b"ijkl")
+
+        # The least recently used block was evicted, to stay within 10 bytes
+        self.assertEqual(cache.num_bytes, 8)
+        self.assertEqual(cache.get((1, 2, 0)), None)
+        self.assertTrue((1, 1, 0) in cache)
+        self.assertTrue((1, 3, 0) in cache)
+
+        # Blocks larger than the cache aren't kept
+        cache.add((1, 4, 0), b"m" * 11)
+        self.assertFalse((1, 4, 0) in cache)
+
+
+
 class BaseTests(unittest.TestCase):
     # self.file_contents = { name: data }
 
@@ -371,6 +611,27 @@ class TestHappy(BaseTests):
 
         self.assertNotEqual(get_inode("dir1/name3.ext"), get_inode("dir5/name1.ext"))
 
+    @unittest.skipIf(not hasattr(os.stat_result, 'st_mtime_ns'), "Requires nanosecond times")
+    def test_hardlink_tree_timestamp_ignore_ns(self):
+        # A newer time that a float can't hold exactly
+        newer_ns = (int(time.time()) + 100) * 1000000000 + 123456789
+        os.utime("dir4/name1.ext", ns=(newer_ns, newer_ns))
+
+        options = hardlinkable.get_default_parser_options()
+        options.linking_enabled = True
+        options.ignore_time = True
+        linker = hardlinkable.Hardlinkable(options)
+        linker.run([self.root])
+        self.verify_file_contents()
+
+        # The linked inode has the newer time, exactly, as does its statinfo
+        self.assertEqual(get_inode("dir1/name1.ext"), get_inode("dir4/name1.ext"))
+        statinfo = os.stat("dir1/name1.ext")
+        self.assertEqual(statinfo.st_mtime_ns, newer_ns)
+        fsdev = linker._fsdevs[statinfo.st_dev]
+        self.assertEqual(fsdev.ino_stat[statinfo.st_ino].st_mtime_ns, newer_ns)
+        self.assertEqual(fsdev.ino_stat[statinfo.st_ino].st_atime_ns, newer_ns)
+
     def test_hardlink_tree_ignore_permissions(self):
         sys.argv = ["hardlinkable.py", "--enable-linking", "--quiet", "--ignore-perms", self.root]
         hardlinkable.main()
@@ -674,7 +935,7 @@ class TestXattr(BaseTests):
             self.xattrs.append(xattr.xattr(filename))
 
     def test_one_xattr(self):
-        self.xattrs[0].set(b"name1", b"value1")
+        self.xattrs[0].set(b"user.name1", b"value1")
 
         sys.argv = ["hardlinkable.py", "--enable-linking", "--quiet", self.root]
         hardlinkable.main()
@@ -684,8 +945,8 @@ class TestXattr(BaseTests):
         self.assertEqual(get_inode("b1"), get_inode("c1"))
 
     def test_two_equal_xattr(self):
-        self.xattrs[0].set(b"name1", b"value1")
-        self.xattrs[1].set(b"name1", b"value1")
+        self.xattrs[0].set(b"user.name1", b"value1")
+        self.xattrs[1].set(b"user.name1", b"value1")
 
         sys.argv = ["hardlinkable.py", "--enable-linking", "--quiet", self.root]
         hardlinkable.main()
@@ -696,8 +957,8 @@ class TestXattr(BaseTests):
         self.assertNotEqual(get_inode("b1"), get_inode("c1"))
 
     def test_two_non_equal_name_xattr(self):
-        self.xattrs[0].set(b"name1", b"value1")
-        self.xattrs[1].set(b"name2", b"value1")
+        self.xattrs[0].set(b"user.name1", b"value1")
+        self.xattrs[1].set(b"user.name2", b"value1")
 
         sys.argv = ["hardlinkable.py", "--enable-linking", "--quiet", self.root]
         hardlinkable.main()
@@ -708,8 +969,8 @@ class TestXattr(BaseTests):
         self.assertNotEqual(get_inode("b1"), get_inode("c1"))
 
     def test_two_non_equal_value_xattr(self):
-        self.xattrs[0].set(b"name1", b"value1")
-        self.xattrs[1].set(b"name1", b"value2")
+        self.xattrs[0].set(b"user.name1", b"value1")
+        self.xattrs[1].set(b"user.name1", b"value2")
 
         sys.argv = ["hardlinkable.py", "--enable-linking", "--quiet", self.root]
         hardlinkable.main()
@@ -720,8 +981,8 @@ class TestXattr(BaseTests):
         self.assertNotEqual(get_inode("b1"), get_inode("c1"))
 
     def test_two_non_equal_xattr(self):
-        self.xattrs[0].set(b"name1", b"value1")
-        self.xattrs[1].set(b"name2", b"value2")
+        self.xattrs[0].set(b"user.name1", b"value1")
+        self.xattrs[1].set(b"user.name2", b"value2")
 
         sys.argv = ["hardlinkable.py", "--enable-linking", "--quiet", self.root]
         hardlinkable.main()
@@ -731,9 +992,40 @@ class TestXattr(BaseTests):
         self.assertNotEqual(get_inode("a1"), get_inode("c1"))
         self.assertNotEqual(get_inode("b1"), get_inode("c1"))
 
+    def test_xattr_fingerprint_buckets(self):
+        self.xattrs[0].set(b"user.name1", b"value1")
+        self.xattrs[1].set(b"user.name1", b"value1")
+        self.xattrs[2].set(b"user.name1", b"value2")
+
+        options = hardlinkable.get_default_parser_options()
+        options.printstats = False
+        stats = hardlinkable.Hardlinkable(options).run(self.root)
+
+        # The file with differing xattrs was never a candidate
+        self.assertEqual(stats.num_hash_misses, 2)
+        self.assertEqual(stats.num_comparisons, 1)
+        self.assertEqual(stats.num_hardlinked_thisrun, 1)
+
+    def test_xattr_fingerprint_lone_inode(self):
+        self.make_hardlinkable_file("d1", testdata2)
+        self.xattrs[0].set(b"user.name1", b"value1")
+        self.xattrs[1].set(b"user.name1", b"value1")
+
+        options = hardlinkable.get_default_parser_options()
+        options.printstats = False
+        linker = hardlinkable.Hardlinkable(options)
+        stats = linker.run(self.root)
+        self.assertEqual(stats.num_hardlinked_thisrun, 1)
+
+        # Only the xattrs of the inodes sharing a bucket key were read
+        statinfo = os.stat("d1")
+        fsdev = linker._fsdevs[statinfo.st_dev]
+        self.assertEqual(len(fsdev.ino_xattr), 3)
+        self.assertFalse(statinfo.st_ino in fsdev.ino_xattr)
+
     def test_contentonly_xattr(self):
-        self.xattrs[0].set(b"name1", b"value1")
-        self.xattrs[1].set(b"name2", b"value2")
+        self.xattrs[0].set(b"user.name1", b"value1")
+        self.xattrs[1].set(b"user.name2", b"value2")
 
         sys.argv = ["hardlinkable.py", "--enable-linking", "-c",
                     "--quiet", self.root]
@@ -745,8 +1037,8 @@ class TestXattr(BaseTests):
         self.assertEqual(get_inode("b1"), get_inode("c1"))
 
     def test_ignore_xattr(self):
-        self.xattrs[0].set(b"name1", b"value1")
-        self.xattrs[1].set(b"name2", b"value2")
+        self.xattrs[0].set(b"user.name1", b"value1")
+        self.xattrs[1].set(b"user.name2", b"value2")
 
         sys.argv = ["hardlinkable.py", "--enable-linking", "--ignore-xattr",
                     "--quiet", self.root]
@@ -1012,6 +1304,72 @@ class TestDifferentDevices(BaseTests):
         f4.close()
 
 
+class TestDirWalk(BaseTests):
+    def setUp(self):
+        self.setup_tempdir()
+
+        self.make_hardlinkable_file("dir1/name1.ext", testdata1)
+        self.make_hardlinkable_file("dir1/sub/name2.ext", testdata1)
+        self.make_hardlinkable_file("dir2/name1.ext", testdata2)
+        os.symlink("name1.ext", "dir1/symlink")
+        os.symlink("../dir1", "dir2/dirlink")
+
+    def tearDown(self):
+        os.unlink("dir1/symlink")
+        os.unlink("dir2/dirlink")
+        self.remove_tempdir()
+
+    def walk_results(self, walk_threads=1, sort=True):
+        options = hardlinkable.get_default_parser_options()
+        options.walk_threads = walk_threads
+        hl = hardlinkable.Hardlinkable(options)
+        fileinfos = [(f.dirname, f.filename, f.statinfo.st_ino)
+                     for f in hl.matched_fileinfo(['.'])]
+        if sort:
+            fileinfos.sort()
+        return fileinfos, hl.stats
+
+    def test_walk_skips_non_regular_files(self):
+        fileinfos, stats = self.walk_results()
+        self.assertEqual(fileinfos,
+                         [("dir1", "name1.ext", get_inode("dir1/name1.ext")),
+                          ("dir1/sub", "name2.ext", get_inode("dir1/sub/name2.ext")),
+                          ("dir2", "name1.ext", get_inode("dir2/name1.ext"))])
+        self.assertEqual(stats.num_files, 3)
+        self.assertEqual(stats.num_dirs, 4)
+
+    def test_walk_without_scandir(self):
+        scandir_results = self.walk_results()
+        saved_scandir = hardlinkable._scandir
+        hardlinkable._scandir = None
+        try:
+            lstat_results = self.walk_results()
+            threaded_results = None
+            if hardlinkable._ThreadPoolExecutor is not None:
+                threaded_results = self.walk_results(walk_threads=4)
+        finally:
+            hardlinkable._scandir = saved_scandir
+        self.assertEqual(scandir_results[0], lstat_results[0])
+        self.assertEqual(scandir_results[1].num_dirs, lstat_results[1].num_dirs)
+        self.assertEqual(scandir_results[1].num_files, lstat_results[1].num_files)
+        # The directories are walked serially instead of by threads
+        if threaded_results is not None:
+            self.assertEqual(lstat_results[0], threaded_results[0])
+
+    @unittest.skipIf(hardlinkable._ThreadPoolExecutor is None,
+                     "Requires concurrent.futures module")
+    def test_threaded_walk_order_and_stats(self):
+        for i in range(600):
+            self.make_hardlinkable_file("flat/f%d" % i, str(i))
+        serial_fileinfos, serial_stats = self.walk_results(sort=False)
+        threaded_fileinfos, threaded_stats = self.walk_results(walk_threads=4, sort=False)
+        self.assertEqual(serial_fileinfos, threaded_fileinfos)
+        self.assertEqual(serial_stats.num_dirs, threaded_stats.num_dirs)
+        self.assertEqual(serial_stats.num_files, threaded_stats.num_files)
+        self.assertEqual(serial_stats.num_files_too_small,
+                         threaded_stats.num_files_too_small)
+
+
 class TestNLinkOrderBug(BaseTests):
     """A proposed solution to the 'clustering' issue (where an inode with a
     high number of links has each individual link deleted and recreated) was to
@@ -1186,6 +1544,470 @@ class TestSimpleStats(BaseTests):
         self.assertEqual(stats.bytes_saved_thisrun, 0)
         self.assertEqual(stats.bytes_saved_previously, 4)
 
+    def test_digest_subbucket_stats(self):
+        self.options.linear_search_thresh = 0
+        self.easy_file_maker(self.dirs[:1], self.filenames[:4],
+                             ["a1", "a1", "b2", "c3"])
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+
+        self.assertEqual(stats.num_hash_buckets, 1)
+        self.assertEqual(stats.num_undigested_inodes, 0)
+        self.assertEqual(stats.num_digest_subbuckets, 3)
+        self.assertEqual(stats.max_subbucket_size, 1)
+
+    @unittest.skipIf(not hardlinkable._HASH_ALGORITHMS, "no hashlib algorithms")
+    def test_hash_mode_no_comparisons(self):
+        self.options.hash_algorithm = hardlinkable._HASH_ALGORITHMS[0]
+        self.easy_file_maker(self.dirs[:1], self.filenames[:4],
+                             ["a1", "a1", "b2", "a1"])
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+
+        # Each file is digested once per stage, and only the files with equal
+        # head digests are fully digested.  The digests replace comparisons.
+        self.assertEqual(stats.stage_digests_computed, {'head': 4, 'full': 3})
+        self.assertEqual(stats.stage_bytes_read, {'head': 8, 'full': 6})
+        self.assertEqual(stats.num_digest_matches, 2)
+        self.assertEqual(stats.num_comparisons, 0)
+        self.assertEqual(stats.num_hardlinked_thisrun, 2)
+
+    @unittest.skipIf(not hardlinkable._HASH_ALGORITHMS, "no hashlib algorithms")
+    def test_hash_mode_verify(self):
+        self.options.hash_algorithm = hardlinkable._HASH_ALGORITHMS[-1]
+        self.options.verify_hash = True
+        self.easy_file_maker(self.dirs[:1], self.filenames[:4],
+                             ["a1", "a1", "b2", "a1"])
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+
+        # Only the linked files are compared
+        self.assertEqual(stats.num_comparisons, 2)
+        self.assertEqual(stats.num_equal_comparisons, 2)
+        self.assertEqual(stats.num_hardlinked_thisrun, 2)
+
+    def test_digest_stages(self):
+        self.options.linear_search_thresh = 0
+        bufsize = filecmp.BUFSIZE
+        head = "h" * bufsize
+        self.easy_file_maker(self.dirs[:1], self.filenames[:4],
+                             [head + "a" * bufsize, head + "a" * bufsize,
+                              head + "b" * bufsize, "x" * bufsize * 2])
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+
+        # The tail digest separates the files with equal heads, so only the
+        # files with equal tails are compared.
+        self.assertEqual(stats.stage_digests_computed, {'head': 4, 'tail': 3})
+        self.assertEqual(stats.stage_bytes_read, {'head': 4 * bufsize, 'tail': 3 * bufsize})
+        self.assertEqual(stats.num_comparisons, 1)
+        self.assertEqual(stats.num_hardlinked_thisrun, 1)
+
+    def test_lockstep_comparison(self):
+        self.options.linear_search_thresh = None
+        # (Otherwise small files are compared by their cached head blocks)
+        self.options.block_cache_size = 0
+        self.easy_file_maker(self.dirs[:1], self.filenames[:4],
+                             ["a1", "b2", "c3", "d4"])
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+
+        # Without digests, the third and fourth files were compared to all
+        # their candidates at once
+        self.assertEqual(stats.num_lockstep_comparisons, 2)
+        self.assertEqual(stats.num_comparisons, 6)
+        self.assertEqual(stats.num_comparison_cache_misses, 6)
+        self.assertEqual(stats.num_comparison_cache_hits, 0)
+        self.assertEqual(stats.num_equal_comparisons, 0)
+        self.assertEqual(stats.num_hardlinked_thisrun, 0)
+
+    def test_block_cache(self):
+        self.options.linear_search_thresh = None
+        self.easy_file_maker(self.dirs[:1], self.filenames[:4],
+                             ["a1", "b2", "c3", "d4"])
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+
+        # Each file's head block was read once, and then compared from the
+        # cache (small files entirely so)
+        self.assertEqual(stats.num_block_cache_misses, 4)
+        self.assertEqual(stats.num_block_cache_hits, 8)
+        self.assertEqual(stats.num_lockstep_comparisons, 0)
+        self.assertEqual(stats.num_comparisons, 6)
+        self.assertEqual(stats.num_hardlinked_thisrun, 0)
+
+        self.options.block_cache_size = 0
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.assertEqual(stats.num_block_cache_misses, 0)
+        self.assertEqual(stats.num_block_cache_hits, 0)
+
+    def test_file_pool(self):
+        self.options.linking_enabled = False
+        head = "x" * 9000
+        self.easy_file_maker(self.dirs[:1], self.filenames[:4],
+                             [head + "1", head + "2", head + "3", head + "1"])
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+
+        # Each file was opened once, and then reused for its later digests
+        # and comparisons (how often depends on the order files are found)
+        self.assertEqual(stats.num_hardlinked_thisrun, 1)
+        self.assertEqual(stats.num_file_pool_misses, 4)
+        self.assertTrue(stats.num_file_pool_hits > 0)
+        num_opens = stats.num_file_pool_misses + stats.num_file_pool_hits
+
+        self.options.file_pool_size = 0
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.assertEqual(stats.num_file_pool_misses, num_opens)
+        self.assertEqual(stats.num_file_pool_hits, 0)
+
+    def test_candidate_order(self):
+        self.options.linear_search_thresh = None
+        # Two copies of the same files (all the same size)
+        contents = ["%s%s" % (x, x) for x in "abcde"]
+        self.easy_file_maker(self.dirs[:2], self.filenames[:5], contents + contents)
+
+        self.options.candidate_order = 'likely'
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+        self.assertEqual(stats.num_hardlinked_thisrun, 5)
+
+        # The first copy's files match none of the others, and each of the
+        # second copy's files matched its first candidate (the same name)
+        self.assertEqual(stats.num_hash_list_searches, 9)
+        self.assertEqual(stats.num_list_iterations, (1 + 2 + 3 + 4) + 5)
+
+    def test_match_planner(self):
+        # Two copies of the same files (all the same size)
+        contents = ["%s%s" % (x, x) for x in "abcde"]
+        self.easy_file_maker(self.dirs[:2], self.filenames[:5], contents + contents)
+
+        self.options.match_planner = True
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+        self.assertEqual(stats.num_hardlinked_thisrun, 5)
+
+        # Every search of a non-empty bucket had a planned strategy
+        self.assertEqual(sum(stats.planned_searches.values()), 9)
+        for strategy in stats.planned_searches:
+            self.assertTrue(strategy in hardlinkable._STRATEGIES)
+            self.assertTrue(stats.planned_bytes_read[strategy] >= 0)
+
+    def test_small_file_size(self):
+        self.options.small_file_size = 4096
+        self.easy_file_maker(self.dirs[:1], self.filenames[:4],
+                             ["a1", "b2", "a1", "a1"])
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+
+        # The equal files were found in the same bucket, without comparisons
+        self.assertEqual(stats.num_small_files_keyed, 4)
+        self.assertEqual(stats.num_comparisons, 0)
+        self.assertEqual(stats.num_hash_hits, 2)
+        self.assertEqual(stats.num_hardlinked_thisrun, 2)
+
+    @unittest.skipIf(not hardlinkable._HASH_ALGORITHMS, "Requires hashlib module")
+    def test_small_file_digest_keys(self):
+        self.options.small_file_size = 4096
+        self.options.small_file_inline = 0
+        self.easy_file_maker(self.dirs[:1], self.filenames[:4],
+                             ["a1", "b2", "a1", "a1"])
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+        self.assertEqual(stats.num_small_files_keyed, 4)
+        self.assertEqual(stats.num_comparisons, 0)
+        self.assertEqual(stats.num_hardlinked_thisrun, 2)
+
+    def test_without_hash_algorithms(self):
+        # Without hashlib, there are no --hash or --verify options
+        saved_algorithms = hardlinkable._HASH_ALGORITHMS
+        hardlinkable._HASH_ALGORITHMS = []
+        try:
+            options = hardlinkable.get_default_parser_options()
+            self.assertFalse(hasattr(options, 'verify_hash'))
+            options.linking_enabled = True
+            options.contentonly = True
+            options.small_file_size = 20000
+            options.linear_search_thresh = 0
+            self.options = options
+            self.easy_file_maker(self.dirs[:2], self.filenames[:3],
+                                 ["a1", "b2", "a1", "a1", "a1" * 5000,
+                                  "a1" * 5000])
+            stats = hardlinkable.Hardlinkable(options).run(self.dirs[:2])
+        finally:
+            hardlinkable._HASH_ALGORITHMS = saved_algorithms
+        self.verify_file_contents()
+        self.assertEqual(stats.num_hardlinked_thisrun, 3)
+
+    def test_small_file_keys_read_once(self):
+        self.options.small_file_size = 4096
+        self.easy_file_maker(self.dirs[:2], self.filenames[:2],
+                             ["a1", "a1", "a1", "b2"],
+                             linkfiles=self.filenames[2:3])
+        linker = hardlinkable.Hardlinkable(self.options)
+        small_file_key = linker._small_file_key
+        read_inodes = set()
+
+        # Reading the content of an inode's later pathnames would fail
+        def failing_reread(fileinfo):
+            if fileinfo.statinfo.st_ino in read_inodes:
+                return None
+            read_inodes.add(fileinfo.statinfo.st_ino)
+            return small_file_key(fileinfo)
+        linker._small_file_key = failing_reread
+        stats = linker.run('.')
+        self.verify_file_contents()
+        self.assertEqual(stats.num_small_files_keyed, 4)
+        self.assertEqual(stats.num_hardlinked_thisrun, 2)
+
+    @unittest.skipIf(hardlinkable._sqlite3 is None or not hardlinkable._HASH_ALGORITHMS,
+                     "Requires sqlite3 and hashlib modules")
+    def test_digest_cache(self):
+        self.options.linking_enabled = False
+        self.options.hash_algorithm = hardlinkable._HASH_ALGORITHMS[0]
+        self.options.digest_cache = os.path.join(self.root, "digests.db")
+        self.easy_file_maker(self.dirs[:1], self.filenames[:4],
+                             ["a1", "a1", "b2", "a1"])
+        try:
+            stats = hardlinkable.Hardlinkable(self.options).run(self.dirs[:1])
+            self.assertEqual(stats.num_digest_cache_hits, 0)
+            self.assertEqual(stats.num_digests_computed, 7)
+
+            # The unchanged files' digests are all reused by the next run
+            stats = hardlinkable.Hardlinkable(self.options).run(self.dirs[:1])
+            self.assertEqual(stats.num_digest_cache_hits, 7)
+            self.assertEqual(stats.num_digests_computed, 0)
+            self.assertEqual(stats.num_digest_matches, 2)
+        finally:
+            os.unlink(self.options.digest_cache)
+
+    @unittest.skipIf(hardlinkable._sqlite3 is None or not hardlinkable._HASH_ALGORITHMS,
+                     "Requires sqlite3 and hashlib modules")
+    def test_digest_cache_locked(self):
+        self.options.linking_enabled = False
+        self.options.hash_algorithm = hardlinkable._HASH_ALGORITHMS[0]
+        self.options.digest_cache = os.path.join(self.root, "digests.db")
+        self.easy_file_maker(self.dirs[:1], self.filenames[:4],
+                             ["a1", "a1", "b2", "a1"])
+        saved_timeout = hardlinkable._DIGEST_CACHE_TIMEOUT
+        hardlinkable._DIGEST_CACHE_TIMEOUT = 0
+        locker = None
+        try:
+            stats = hardlinkable.Hardlinkable(self.options).run(self.dirs[:1])
+            self.assertEqual(stats.num_digests_computed, 7)
+
+            # Another run locks the cache after this run has opened it
+            locker = hardlinkable._sqlite3.connect(self.options.digest_cache)
+            linker = hardlinkable.Hardlinkable(self.options)
+            open_digest_cache = linker._open_digest_cache
+
+            def open_then_lock():
+                open_digest_cache()
+                locker.execute("BEGIN EXCLUSIVE")
+            linker._open_digest_cache = open_then_lock
+
+            # The cache is disabled, and the digests are computed instead
+            stats = linker.run(self.dirs[:1])
+            self.assertEqual(stats.num_digest_cache_hits, 0)
+            self.assertEqual(stats.num_digests_computed, 7)
+            self.assertEqual(stats.num_digest_matches, 2)
+            locker.rollback()
+
+            # The cache is still usable by later runs
+            stats = hardlinkable.Hardlinkable(self.options).run(self.dirs[:1])
+            self.assertEqual(stats.num_digest_cache_hits, 7)
+        finally:
+            hardlinkable._DIGEST_CACHE_TIMEOUT = saved_timeout
+            if locker is not None:
+                locker.close()
+            os.unlink(self.options.digest_cache)
+
+    @unittest.skipIf(xattr is None or not hardlinkable._HASH_ALGORITHMS,
+                     "Requires xattr and hashlib modules")
+    def test_digest_xattrs(self):
+        self.options.linking_enabled = False
+        self.options.hash_algorithm = hardlinkable._HASH_ALGORITHMS[0]
+        self.options.digest_xattrs = True
+        self.options.contentonly = False
+        self.options.ignore_time = True
+        self.easy_file_maker(self.dirs[:1], self.filenames[:4],
+                             ["a1", "a1", "b2", "a1"])
+        stats = hardlinkable.Hardlinkable(self.options).run(self.dirs[:1])
+        self.assertEqual(stats.num_digest_xattr_hits, 0)
+        self.assertEqual(stats.num_digests_computed, 7)
+
+        # The digests are read back from the files by the next run, and
+        # don't prevent linking when not all files have them
+        stats = hardlinkable.Hardlinkable(self.options).run(self.dirs[:1])
+        self.assertEqual(stats.num_digest_xattr_hits, 7)
+        self.assertEqual(stats.num_digests_computed, 0)
+        self.assertEqual(stats.num_digest_matches, 2)
+
+    @unittest.skipIf(xattr is None or not hardlinkable._HASH_ALGORITHMS,
+                     "Requires xattr and hashlib modules")
+    def test_digest_xattrs_forged(self):
+        self.options.hash_algorithm = hardlinkable._HASH_ALGORITHMS[0]
+        self.options.digest_xattrs = True
+        self.easy_file_maker(self.dirs[:1], self.filenames[:4],
+                             ["a1", "a1", "b2", "a1"])
+        for filename in self.filenames[:4]:
+            os.utime(os.path.join(self.dirs[0], filename), (1000000, 1000000))
+        self.options.linking_enabled = False
+        hardlinkable.Hardlinkable(self.options).run(self.dirs[:1])
+
+        # Give a differing file the digest xattrs of another file
+        src = xattr.xattr(os.path.join(self.dirs[0], self.filenames[0]))
+        dst = xattr.xattr(os.path.join(self.dirs[0], self.filenames[1]))
+        for name in src.list():
+            if name.startswith(hardlinkable._DIGEST_XATTR_PREFIX):
+                dst.set(name, src.get(name))
+
+        # The xattr digests match, but the contents are compared before linking
+        self.options.linking_enabled = True
+        stats = hardlinkable.Hardlinkable(self.options).run(self.dirs[:1])
+        self.verify_file_contents()
+        self.assertEqual(stats.num_comparisons, stats.num_digest_matches)
+        self.assertEqual(stats.num_hardlinked_thisrun, 2)
+
+    @unittest.skipIf(xattr is None or hardlinkable._sqlite3 is None or
+                     not hardlinkable._HASH_ALGORITHMS,
+                     "Requires xattr, sqlite3 and hashlib modules")
+    def test_digest_cache_and_xattrs(self):
+        self.options.linking_enabled = False
+        self.options.hash_algorithm = hardlinkable._HASH_ALGORITHMS[0]
+        self.options.digest_cache = os.path.join(self.root, "digests.db")
+        self.options.digest_xattrs = True
+        self.easy_file_maker(self.dirs[:1], self.filenames[:4],
+                             ["a1", "a1", "b2", "a1"])
+        try:
+            stats = hardlinkable.Hardlinkable(self.options).run(self.dirs[:1])
+            self.assertEqual(stats.num_digests_computed, 7)
+
+            # Storing the xattrs changed the ctimes, but the cached digests
+            # are still reused
+            stats = hardlinkable.Hardlinkable(self.options).run(self.dirs[:1])
+            self.assertEqual(stats.num_digest_cache_hits, 7)
+            self.assertEqual(stats.num_digest_xattr_hits, 0)
+            self.assertEqual(stats.num_digests_computed, 0)
+        finally:
+            os.unlink(self.options.digest_cache)
+
+    def test_sampled_digest_stage(self):
+        self.options.linear_search_thresh = 0
+        self.options.sample_thresh = 0
+        bufsize = filecmp.BUFSIZE
+        head = "h" * bufsize
+        tail = "t" * bufsize
+        self.easy_file_maker(self.dirs[:1], self.filenames[:3],
+                             [head + c * bufsize + tail for c in "abc"])
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+
+        # Only the sampled middle of the files differs, so no comparisons
+        # were needed to tell them apart
+        self.assertEqual(stats.stage_digests_computed,
+                         {'head': 3, 'tail': 3, 'sample': 3})
+        self.assertEqual(stats.stage_survivors.get('sample', 0), 0)
+        self.assertEqual(stats.num_comparisons, 0)
+
+    @unittest.skipIf(hardlinkable._posix_fadvise is None,
+                     "posix_fadvise not available")
+    def test_gentle_io(self):
+        self.options.gentle_io = True
+        self.options.linking_enabled = False
+        self.easy_file_maker(self.dirs[:1], self.filenames[:3], ["1", "1", "2"])
+        pathnames = [os.path.join(self.dirs[0], x) for x in self.filenames[:3]]
+        for pathname in pathnames:
+            os.utime(pathname, (1000000000, os.stat(pathname).st_mtime))
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.assertEqual(stats.num_hardlinked_thisrun, 1)
+
+        # The file access times are left alone
+        for pathname in pathnames:
+            self.assertEqual(os.stat(pathname).st_atime, 1000000000)
+
+    @unittest.skipIf(hardlinkable._posix_fadvise is None,
+                     "posix_fadvise not available")
+    def test_gentle_io_readahead(self):
+        self.options.gentle_io = True
+        self.options.linking_enabled = False
+        self.options.linear_search_thresh = 100
+        # Sparse files are compared pairwise, reading ahead the next one
+        self.easy_file_maker(self.dirs[:1], self.filenames[:6],
+                             ["a1", "b2", "c3", "d4", "e5", "a1"])
+        for filename in self.filenames[:6]:
+            with open(os.path.join(self.dirs[0], filename), "r+b") as f:
+                f.truncate(1024 * 1024)
+        saved_open = os.open
+        num_opens = [0]
+
+        def counting_open(*args, **kwargs):
+            num_opens[0] += 1
+            return saved_open(*args, **kwargs)
+        os.open = counting_open
+        try:
+            stats = hardlinkable.Hardlinkable(self.options).run('.')
+        finally:
+            os.open = saved_open
+        self.assertEqual(stats.num_hardlinked_thisrun, 1)
+
+        # The candidates are only read ahead through the file pool, so no
+        # files are opened other than those that are read
+        self.assertEqual(num_opens[0], stats.num_file_pool_misses)
+
+    def test_ordered_reads(self):
+        contents = ["a1", "a1", "b2", "a1", "b2", "c3"]
+        self.easy_file_maker(self.dirs[:2], self.filenames[:3], contents[:])
+        self.options.linking_enabled = False
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+
+        # The same files are linked, and the digests are computed up front
+        self.options.ordered_reads = True
+        ordered_stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.assertEqual(ordered_stats.num_hardlinked_thisrun,
+                         stats.num_hardlinked_thisrun)
+        self.assertEqual(ordered_stats.bytes_saved_thisrun,
+                         stats.bytes_saved_thisrun)
+        self.assertEqual(ordered_stats.num_digests_computed, 6)
+
+        self.options.linking_enabled = True
+        hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+
+    def test_hash_workers(self):
+        contents = ["a1", "a1", "b2", "a1", "b2", "c3"]
+        self.easy_file_maker(self.dirs[:2], self.filenames[:3], contents[:])
+        self.options.linking_enabled = False
+        self.options.hash_algorithm = hardlinkable._HASH_ALGORITHMS[0]
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+
+        # The digests are computed up front, by the hashing processes
+        self.options.hash_workers = 2
+        pooled_stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.assertEqual(pooled_stats.num_hardlinked_thisrun,
+                         stats.num_hardlinked_thisrun)
+        self.assertEqual(pooled_stats.bytes_saved_thisrun,
+                         stats.bytes_saved_thisrun)
+        self.assertEqual(pooled_stats.num_digest_matches,
+                         stats.num_digest_matches)
+        # (The unique file's head digest rules out its full digest)
+        self.assertEqual(pooled_stats.stage_digests_computed['full'], 5)
+
+        self.options.linking_enabled = True
+        hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+
+    def test_samename_no_different_name_comparisons(self):
+        self.options.samename = True
+        self.easy_file_maker(self.dirs[:2], self.filenames[:2], ["1", "1", "1", "1"])
+        stats = hardlinkable.Hardlinkable(self.options).run('.')
+        self.verify_file_contents()
+
+        # Only the equally named files are compared (and linked)
+        self.assertEqual(stats.num_comparisons, 2)
+        self.assertEqual(stats.num_hardlinked_thisrun, 2)
+        self.assertEqual(stats.bytes_saved_thisrun, 2)
+
     def test_unwalked_dir_links_no_equal_files(self):
         for dirname in self.dirs[:2]:
             self.make_hardlinkable_file(dirname, None)
@@ -1480,6 +2302,62 @@ class TestRandomizedOrderingPartialTreeWalk(RandomizedOrderingBase):
         self.check_equalfiles_stats(stats)
 
 
+class TestRandomizedOrderingMatchThreads(RandomizedOrderingBase):
+    def compare_serial_and_concurrent_matching(self, gen_files=True):
+        if gen_files:
+            self.gen_files()
+        self.options.linking_enabled = False
+        stats = hardlinkable.Hardlinkable(self.options).run([self.root])
+
+        # Count the groups matched by the threads
+        self.options.match_threads = 4
+        linker = hardlinkable.Hardlinkable(self.options)
+        match_group = linker._match_group
+        matched_groups = []
+
+        def counted_match_group(group):
+            matched_groups.append(len(group))
+            return match_group(group)
+        linker._match_group = counted_match_group
+        threaded_stats = linker.run([self.root])
+
+        # The link plan and all the stats (except times) are identical
+        stats_dict = dict(stats.__dict__)
+        threaded_stats_dict = dict(threaded_stats.__dict__)
+        for d in (stats_dict, threaded_stats_dict):
+            del d['starttime']
+            del d['endtime']
+        self.assertEqual(stats_dict, threaded_stats_dict)
+        return matched_groups
+
+    def test_linking(self):
+        self.compare_serial_and_concurrent_matching()
+
+    def test_samename(self):
+        self.options.samename = True
+        self.compare_serial_and_concurrent_matching()
+
+    def make_large_group(self, num_files):
+        # Same-size files, ten copies of each content
+        now = time.time()
+        for i in range(num_files):
+            pathname = "large%d" % i
+            self.make_hardlinkable_file(pathname, "%06d" % (i % (num_files // 10)))
+            os.utime(pathname, (now, now))
+
+    def test_large_group(self):
+        self.make_large_group(300)
+        matched_groups = self.compare_serial_and_concurrent_matching(gen_files=False)
+        self.assertEqual(matched_groups, [300])
+
+    def test_caches_may_evict(self):
+        # Matched serially, as the comparison cache could fill up
+        self.make_large_group(300)
+        self.options.comparison_cache_size = 100
+        matched_groups = self.compare_serial_and_concurrent_matching(gen_files=False)
+        self.assertEqual(matched_groups, [])
+
+
 @unittest.skipIf(skip_slowtests, "The randomized linear search vs digest comparisons can take some time...")
 class TestDigestVsLinearSearch(RandomizedOrderingBase):
     def compare_stats(self, stats1, stats2):